@@ -3,6 +3,7 @@ Running this file makes all of the key stuff happen.
 """
 
 import common
+import config
 import bible
 import tfidf
 import topic
@@ -24,12 +25,15 @@ def main():
         print("No data from get_. Check your args.")
         return
 
-    # ADD SENTIMENT
-    common.add_sentiment(texts)
+    # ADD SENTIMENT (by sentence, it waits for Topic's parse)
+    if not config.SENTIMENT_BY_SENTENCE:
+        common.add_sentiment(texts)
 
 
     # FIND TOPICS
     tb = topic.Topic(corpus_name, texts)
+    if config.SENTIMENT_BY_SENTENCE:
+        tb.add_sentiment()
     tb.detect_ngram()
     tb.prune_topics_and_adopt()
     # summary = tb.summarize_texts()
@@ -49,7 +53,7 @@ def main():
 
     # SEND IT TO JSON
     tb.export_topics()
-    common.export_texts(texts, corpus_name)
+    common.export_texts(tb.texts, corpus_name)
 
 
 if __name__ == "__main__":
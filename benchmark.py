@@ -0,0 +1,168 @@
+"""
+Timing checks for the slow spots in a run. These aren't part of the pipeline; run this file directly to see where a
+change helps (or hurts), e.g.:  python benchmark.py
+"""
+
+import os
+import time
+
+import spacy.symbols as ss
+from spacy.tokens import Doc
+
+import bible
+import card_renderer
+import common
+import config
+import language_model
+import serializers
+
+
+# The same proper-noun entity types that Topic uses.
+ENTITIES = {ss.PERSON, ss.NORP, ss.FACILITY, ss.ORG, ss.GPE, ss.LOC, ss.PRODUCT, ss.EVENT, ss.WORK_OF_ART,
+            ss.LANGUAGE}
+
+
+def read_word_file(file_name):
+    """
+    :param file_name: (str) A space-delimited word file in config.INPUT_DIR (e.g., stop_words.txt).
+    :return: (set) The words in that file.
+    """
+    try:
+        with open(config.INPUT_DIR + file_name, 'r') as file:
+            return set(file.read().split(' '))
+    except IOError:
+        return set()
+
+
+def legacy_merge_entities(doc, entities, stop_words):
+    """
+    The entity merge that _tokenize used to run: merge one bigram at a time, keeping track of the doc length by hand.
+    Kept here so we can time language_model.merge_entities against it.
+    """
+    doc_len = len(doc)
+    for token in doc:
+        if token.i + 1 < doc_len and token.ent_type in entities and \
+                token.text.lower() not in stop_words and token.text not in ' ':
+            next_token = doc[token.i + 1]
+            while token.i + 1 < doc_len and next_token.ent_type == token.ent_type and \
+                    next_token.text.lower() not in stop_words and next_token.text not in ' ':
+                doc[token.i:token.i + 2].merge()
+                doc_len -= 1
+        if token.i + 1 >= doc_len:
+            break
+    return doc
+
+
+def bench_entity_merge(book='Psalms', chapter_count=5, repeat=5):
+    """
+    Time the pair-at-a-time merge against the single retokenization on a book's longest chapters (for Psalms, that's
+    Psalm 119 and friends), and make sure that both produce the same tokens.
+
+    :param book: (str) The Bible book to pull chapters from.
+    :param chapter_count: (int) How many of the longest chapters to use.
+    :param repeat: (int) How many times to time each merge (we report the best run).
+    :return: None
+    """
+    texts = bible.Bible(book).get_texts()
+    texts = texts.assign(length=texts['text'].str.len()).sort_values('length', ascending=False)[:chapter_count]
+
+    nlp = language_model.load()
+    stop_words = read_word_file('stop_words.txt')
+    known_entities = language_model.KnownEntityMatcher(nlp, read_word_file('known_entities.txt'), ENTITIES)
+    docs = [known_entities(doc) for doc in nlp.pipe(texts['text'])]
+    print('{}: {} chapters ({}), {:,} tokens'.format(book, len(docs), ', '.join(texts['title']),
+                                                    sum(len(doc) for doc in docs)))
+
+    results = {}
+    for name, merge in [('pairwise Span.merge', legacy_merge_entities),
+                        ('single retokenize', language_model.merge_entities)]:
+        best = None
+        for _ in range(repeat):
+            copies = [Doc(nlp.vocab).from_bytes(doc.to_bytes()) for doc in docs]  # each run merges fresh docs
+            start_time = time.time()
+            merged = [merge(doc, ENTITIES, stop_words) for doc in copies]
+            elapsed = time.time() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = [[token.text for token in doc] for doc in merged]
+        print('  {:<20} {:8.1f} ms'.format(name, best * 1000))
+
+    assert len(set(str(tokens) for tokens in results.values())) == 1, 'The two merges produced different tokens.'
+
+
+def bench_serializers(corpus_name='Bible', repeat=3):
+    """
+    Compare our output formats on a run's exports (see serializers): for each, the file size and the best time to write
+    (encode) and read back (decode) it. Run the whole Bible first, so XYZ-Topics.txt, XYZ-Texts.txt and XYZ-Vec.json are
+    in config.OUTPUT_DIR; missing exports and formats whose package isn't installed are skipped.
+
+    :param corpus_name: (str) The corpus whose exports we use.
+    :param repeat: (int) How many times to time each format (we report the best run).
+    :return: None
+    """
+    formats = {}
+    for name in serializers.SERIALIZERS:
+        try:
+            formats[name] = serializers.get_serializer(name)
+        except AssertionError as error:  # its package isn't installed
+            print('{}: {}'.format(name, error))
+    folder = os.path.join(config.OUTPUT_DIR, 'serializer_bench')
+    os.makedirs(folder, exist_ok=True)
+
+    for suffix in ('Topics.txt', 'Texts.txt', 'Vec.json'):
+        file_name = config.OUTPUT_DIR + '{}-{}'.format(corpus_name, suffix)
+        if not os.path.exists(file_name):
+            print('{}: not found, skipping'.format(file_name))
+            continue
+        value = serializers.JsonSerializer().load(file_name)
+        print('{}-{} ({:,.1f} MB as JSON)'.format(corpus_name, suffix, os.path.getsize(file_name) / 1024 / 1024))
+
+        for name, serializer in formats.items():
+            encode = decode = None
+            for _ in range(repeat):
+                start_time = time.time()
+                saved_name, size = serializers.save(value, os.path.join(folder, suffix), serializer)
+                encode = min(encode or float('inf'), time.time() - start_time)
+                start_time = time.time()
+                loaded = serializer.load(saved_name)
+                decode = min(decode or float('inf'), time.time() - start_time)
+            assert loaded == value, 'The {} format didn\'t round-trip.'.format(name)
+            print('  {:<10} {:10,.1f} MB {:8.1f} ms encode {:8.1f} ms decode'.format(
+                name, size / 1024 / 1024, encode * 1000, decode * 1000))
+
+
+def bench_card_modes(book='Bible'):
+    """
+    Compare the html card modes (see card_renderer) on a book's texts (or the whole Bible): for each, the size of
+    XYZ-Texts.txt, and how long rendering takes. Eager renders every card up front; lazy renders one card per request,
+    so we time rendering each card on its own; with none, the UI does the work.
+
+    :param book: (str) The Bible book (or 'Bible').
+    :return: None
+    """
+    texts = bible.Bible(book).get_texts()
+    texts = texts.assign(sentiment=texts['sentiment'].fillna(0))
+    renderer = card_renderer.CardRenderer()
+    corpus_name = book + '-CardBench'
+
+    print('{}: {:,} texts'.format(book, len(texts)))
+    for mode in card_renderer.CARD_MODES:
+        size = common.export_texts(texts, corpus_name, html_cards=mode)
+        if mode == 'eager':
+            start_time = time.time()
+            renderer.render_all(texts)
+            render = '{:8.1f} ms for all cards'.format((time.time() - start_time) * 1000)
+        elif mode == 'lazy':
+            records = texts.to_dict('records')
+            start_time = time.time()
+            for text in records:
+                renderer.render(text)
+            render = '{:8.3f} ms per card'.format((time.time() - start_time) * 1000 / len(texts))
+        else:
+            render = '       - (in the UI)'
+        print('  {:<6} {:10,.1f} MB {}'.format(mode, size / 1024 / 1024, render))
+
+
+if __name__ == "__main__":
+    bench_entity_merge()
+    bench_serializers()
+    bench_card_modes()
@@ -0,0 +1,184 @@
+"""
+Render the html cards that the UI shows for each text. export_texts used to format a card for every text and store it
+in XYZ-Texts.txt, which stores each text twice (once as text, once inside its card). Now cards can be:
+    'eager': rendered for every text at once (vectorized over the DataFrame) and stored as htmlCard, as before
+    'lazy': rendered one at a time, when the UI asks for them, by a small local service (see serve)
+    'none': not rendered at all; the UI builds them from each text's fields
+The template is compiled once (split into its literal text and fields), so rendering a card is a single join.
+
+To serve cards for an export:  python card_renderer.py Data/Matthew-Texts.txt [port]
+"""
+
+import json
+import os
+import string
+import sys
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import config
+import serializers
+
+
+CARD_MODES = ('eager', 'lazy', 'none')
+
+# The html card that the UI presents for each text
+CARD_TEMPLATE = "<div class='card bs-callout {card_sent}' id='card_{id}'>" \
+                "<div class='cardTime'>{time_and_count}</div>" \
+                "<a href='{url}' target='_blank'><img src='{logo_path}' class='cardImage' /></a>" \
+                "<div class='cardTitle h4'>" \
+                "<a href='javascript:void(0);' onclick='cardToggle({id})'>{card_title}</a></div>" \
+                "<a href='javascript:void(0);' onclick='cardToggle({id})'>" \
+                "<i class='fa fa-minus-square-o fa-lg cardToggle'></i></a>" \
+                "<div class='cardText' id='text_{id}'>{card_text}</div>" \
+                "</div>"
+
+# The text fields a card is built from, beyond those that every export has (for the UI or service to build it later)
+CARD_FIELDS = ['time', 'count', 'logoFile', 'url']
+
+
+class CardRenderer(object):
+    """
+    Fill CARD_TEMPLATE from texts: a whole DataFrame at once (render_all) or one text at a time (render).
+    """
+
+    def __init__(self, template=CARD_TEMPLATE, text_length_max=16000):
+        """
+        :param template: (str) A str.format template using the fields that fields() builds.
+        :param text_length_max: (int) Cut card text off after this many characters.
+        """
+        self.text_length_max = text_length_max
+        self.parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
+
+    def fields(self, text):
+        """
+        :param text: (dict or pd.Series) One text, with textId, title, sentiment, text, and the CARD_FIELDS.
+        :return: (dict) {template field: str}
+        """
+        sentiment = text['sentiment']
+        # Are either (or both) post time and text count available?
+        time_and_count = (('' if pd.isnull(text['time']) else text['time']) + ' | ' +
+                          ('' if pd.isnull(text['count']) else 'text count: <i>' + text['count'] + '</i>')).strip(' |')
+        return {'id': str(text['textId']),
+                'card_sent': 'bs-callout-neg' if sentiment < -0.33 else ('bs-callout-pos' if sentiment > 0.33 else ''),
+                'time_and_count': time_and_count,
+                'logo_path': r'Logos\\' + text['logoFile'],
+                'card_title': str(text['title']),
+                'url': 'https://{}'.format(text['url']),
+                'card_text': text['text'][:self.text_length_max]}
+
+    def columns(self, texts):
+        """
+        fields() for every text at once.
+        :param texts: (pd.DataFrame) Texts, with textId, title, sentiment, text, and the CARD_FIELDS.
+        :return: (dict) {template field: pd.Series of str}
+        """
+        sentiment = texts['sentiment']
+        has_count = texts['count'].notnull()
+        counts = pd.Series('', index=texts.index, dtype=object)
+        counts[has_count] = 'text count: <i>' + texts['count'][has_count].astype(object) + '</i>'
+        times = texts['time'].astype(object).where(texts['time'].notnull(), '')
+        return {'id': texts['textId'].astype(str),
+                'card_sent': pd.Series(np.select([sentiment < -0.33, sentiment > 0.33],
+                                                 ['bs-callout-neg', 'bs-callout-pos'], ''), index=texts.index),
+                'time_and_count': (times + ' | ' + counts).str.strip(' |'),
+                'logo_path': r'Logos\\' + texts['logoFile'],
+                'card_title': texts['title'].astype(str),
+                'url': 'https://' + texts['url'],
+                'card_text': texts['text'].str[:self.text_length_max]}
+
+    def render(self, text):
+        """
+        :param text: (dict or pd.Series) One text (see fields).
+        :return: (str) Its card.
+        """
+        fields = self.fields(text)
+        return ''.join(literal + (fields[field] if field else '') for literal, field in self.parts)
+
+    def render_all(self, texts):
+        """
+        :param texts: (pd.DataFrame) Texts (see columns).
+        :return: (pd.Series of str) Their cards, on the same index.
+        """
+        columns = self.columns(texts)
+        cards = pd.Series('', index=texts.index, dtype=object)
+        for literal, field in self.parts:
+            cards = cards + literal + columns[field] if field else cards + literal
+        return cards
+
+
+def text_source(file_name):
+    """
+    :param file_name: (str) An XYZ-Texts export (in any output format), or the XYZ-Texts-Index.txt of a sharded one.
+    :return: (function) text_id -> the text's exported fields (dict), or None for an unknown textId. A sharded export
+        is read one text at a time, by byte range; a single file is read once, up front.
+    """
+    if not file_name.endswith('-Index.txt'):
+        texts = {text['id']: text for text in serializers.for_file(file_name).load(file_name, array=True)}
+        return texts.get
+
+    with open(file_name, 'r') as file:
+        index = json.load(file)
+    folder = os.path.dirname(file_name)
+
+    def get(text_id):
+        if text_id not in index['texts']:
+            return None
+        shard, offset, length = index['texts'][text_id]
+        with open(os.path.join(folder, index['shards'][shard]), 'rb') as file:
+            file.seek(offset)
+            return serializers.for_file(index['shards'][shard]).loads(file.read(length))
+    return get
+
+
+def serve(file_name, port=None, text_length_max=16000):
+    """
+    Serve the cards for an export that was written with html_cards='lazy' (or 'none'): GET /cards/<textId> returns
+    that text's card. Runs until interrupted.
+    :param file_name: (str) The export (see text_source).
+    :param port: (int) The local port to listen on. Defaults to config.CARD_SERVER_PORT.
+    :param text_length_max: (int) Cut card text off after this many characters.
+    :return: None
+    """
+    get_text = text_source(file_name)
+    renderer = CardRenderer(text_length_max=text_length_max)
+
+    class CardHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            start_time = time.time()
+            text = get_text(urllib.parse.unquote(self.path[len('/cards/'):])) if self.path.startswith('/cards/') \
+                else None
+            if text is None:
+                self.send_error(404, 'No such text')
+                return
+
+            card = renderer.render(dict(text, textId=text['id'])).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(card)))
+            self.send_header('Access-Control-Allow-Origin', '*')  # the UI is served from elsewhere
+            self.end_headers()
+            self.wfile.write(card)
+            self.log_message('"%s" 200 %d bytes, rendered in %.2f ms', self.requestline, len(card),
+                             (time.time() - start_time) * 1000)
+
+        def log_request(self, code='-', size='-'):
+            pass  # do_GET logs its own requests, with the render time
+
+    port = port or config.CARD_SERVER_PORT
+    server = ThreadingHTTPServer(('localhost', port), CardHandler)
+    print('Serving cards for {} at http://localhost:{}/cards/<textId>'.format(file_name, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
@@ -2,87 +2,303 @@
 A series of functions that'll be used commonly by other classes throughout TopicStudy
 """
 
+import glob
+import itertools
 import json
+import multiprocessing
+import os
+import time
 from datetime import datetime
 
 import pandas as pd
 
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 
+from card_renderer import CARD_FIELDS, CARD_MODES, CardRenderer
 import config
+from delta_export import DeltaExport
+import serializers
+from sentiment_cache import SentimentCache, analyzer_version
 
 
 # alt: from vaderSentiment import SentimentIntensityAnalyzer
 
 
-def export_texts(texts, corpus_name, data_date='', text_length_max=16000):
+def export_texts(texts, corpus_name, data_date='', text_length_max=16000, shard_bytes=None, output_format=None,
+                 html_cards=None, delta=None, snapshot=False):
     """
     Prepare analyzed texts for UI, then saves. Create htmlCard, format sentiment, jettison fields we no longer need.
+    Cards are big (each holds its text again), so they can instead be served on demand or left to the UI; see
+    card_renderer.
+    With shard_bytes, the texts go into shards (XYZ-Texts-000.txt, ...) plus an index (XYZ-Texts-Index.txt), so the UI
+    can fetch just the texts it needs (see ShardWriter) rather than one XYZ-Texts.txt.
+    With delta, we only write the texts that changed since the last export (see delta_export), unless this export
+    must be a full snapshot.
 
     :param texts: A dict of dicts containing our text. We assume it contains the following:
         {text_id: {text: 'abc', title: 'xyz', time: '10:15', sentiment: 0, logoFile: 'esv.png', url: 'www.esv.com?a=b'}}
     :param corpus_name:
     :param data_date:
     :param text_length_max:
-    :return:
+    :param shard_bytes: (int) About how big each shard should be; 0 writes a single file. Defaults to
+        config.TEXTS_SHARD_BYTES.
+    :param output_format: (str) 'json', 'json.gz', 'json.zst' or 'msgpack' (see serializers). Defaults to
+        config.OUTPUT_FORMAT.
+    :param html_cards: (str) 'eager' (store each text's htmlCard), 'lazy' or 'none' (store the fields a card is built
+        from instead; see card_renderer). Defaults to config.HTML_CARDS.
+    :param delta: (bool) Write a delta (plus XYZ-Texts-Manifest.txt) rather than every text? Defaults to
+        config.DELTA_EXPORTS.
+    :param snapshot: (bool) With delta, write the full export anyway (and start a new chain of deltas).
+    :return: (int) The size of the full export we wrote, in bytes (0 if we only wrote a delta).
     """
 
     # TODO: sentiment could be 0 to 1 or -1 to 1
 
     assert len(texts) > 0, "No text data to export."
+    start_time = time.time()
 
-    # A template for the html card that will get presented in the UI
-    html_card = "<div class='card bs-callout {card_sent}' id='card_{id}'>" \
-                "<div class='cardTime'>{time_and_count}</div>" \
-                "<a href='{url}' target='_blank'><img src='{logo_path}' class='cardImage' /></a>" \
-                "<div class='cardTitle h4'>" \
-                "<a href='javascript:void(0);' onclick='cardToggle({id})'>{card_title}</a></div>" \
-                "<a href='javascript:void(0);' onclick='cardToggle({id})'>" \
-                "<i class='fa fa-minus-square-o fa-lg cardToggle'></i></a>" \
-                "<div class='cardText' id='text_{id}'>{card_text}</div>" \
-                "</div>"
-
-    save_texts = []
-    for _, row in texts.iterrows():
-        # for text_id, text in texts.items():
-        sent_class = 'bs-callout-neg' if row['sentiment'] < -0.33 else ('bs-callout-pos'
-                                                                        if row['sentiment'] > 0.33 else '')
-
-        # Are either (or both) post time and text count available?
-        time_and_count = (('' if pd.isnull(row['time']) else row['time']) + ' | ' +
-                          ('' if pd.isnull(row['count']) else 'text count: <i>' + row['count'] + '</i>')).strip(' |')
-
-        card = html_card.format(id=row['textId'], card_sent=sent_class,
-                                time_and_count=time_and_count,
-                                logo_path=r'Logos\\' + row['logoFile'],
-                                card_title=row['title'],
-                                url='https://{}'.format(row['url']),
-                                card_text=row['text'][:text_length_max])
-
-        save_texts.append({"id": row['textId'], "title": row['title'], "sentiment": row['sentiment'],
-                           "text": row['text'], "source": row['source'], "htmlCard": card})
-
-        # Build file name and save
-        if data_date:
-            date = datetime.strptime(data_date, "%Y-%m-%d").strftime('%d')  # from YYYY-MM-DD to DD
-            file_name = '{}-{}-Texts.txt'.format(corpus_name, date)
-        else:
-            file_name = '{}-Texts.txt'.format(corpus_name)
-
-        with open(config.OUTPUT_DIR + file_name, 'w') as file:
-            json.dump(save_texts, file)
-
-
-def add_sentiment(texts):
+    # Build file name
+    if data_date:
+        date = datetime.strptime(data_date, "%Y-%m-%d").strftime('%d')  # from YYYY-MM-DD to DD
+        file_name = '{}-{}-Texts.txt'.format(corpus_name, date)
+    else:
+        file_name = '{}-Texts.txt'.format(corpus_name)
+
+    delta = DeltaExport('{}-Texts'.format(corpus_name), 'id') if (config.DELTA_EXPORTS if delta is None else delta) \
+        else None
+
+    # Each text is written once, as the next item of the JSON array (not the whole list again for every text).
+    shard_bytes = config.TEXTS_SHARD_BYTES if shard_bytes is None else shard_bytes
+    serializer = serializers.get_serializer(output_format or config.OUTPUT_FORMAT)
+    if delta and not (snapshot or delta.needs_snapshot()):
+        writer = None
+    elif shard_bytes > 0:
+        file_name = file_name[:-len('.txt')]  # the shards and index add their own suffixes
+        writer = ShardWriter(config.OUTPUT_DIR + file_name, shard_bytes, serializer)
+    else:
+        writer = ArrayWriter(config.OUTPUT_DIR + file_name, serializer)
+
+    html_cards = html_cards or config.HTML_CARDS
+    assert html_cards in CARD_MODES, 'html_cards is one of: {}.'.format(', '.join(CARD_MODES))
+    render_time = time.time()
+    cards = CardRenderer(text_length_max=text_length_max).render_all(texts) if html_cards == 'eager' else None
+    render_time = time.time() - render_time
+
+    for i, (_, row) in enumerate(texts.iterrows()):
+        item = {"id": row['textId'], "title": row['title'], "sentiment": row['sentiment'],
+                "text": row['text'], "source": row['source']}
+        if cards is not None:
+            item["htmlCard"] = cards.iat[i]
+        else:  # whoever renders the card later needs these
+            item.update({field: None if pd.isnull(row[field]) else row[field] for field in CARD_FIELDS})
+        if writer:
+            writer.write(item)
+        if delta:
+            delta.add(item)
+
+    if writer:
+        writer.close()
+        print('Exported {:,} texts to {}{} ({:,.1f} MB; cards: {}{}) in {:.1f}s'.format(
+            writer.count, file_name + serializer.suffix,
+            ' ({:,} shards + index)'.format(len(writer.shards)) if shard_bytes > 0 else '',
+            writer.file_bytes / 1024 / 1024, html_cards,
+            ', rendered in {:.2f}s'.format(render_time) if html_cards == 'eager' else '', time.time() - start_time))
+    if delta:
+        delta.save(os.path.basename(writer.file_name if shard_bytes <= 0 else writer.base_name + '-Index.txt')
+                   if writer else None, serializer)
+    return writer.file_bytes if writer else 0
+
+
+class ArrayWriter(object):
+    """
+    Write an array one item at a time, in any of our output formats (see serializers). For plain JSON, that's byte for
+    byte what json.dump(items, file) writes for the whole list. Items go to a temp file next to the target, which only
+    replaces the target on close(), so readers never see a half-written file.
+    """
+
+    def __init__(self, file_name, serializer=None):
+        """
+        :param file_name: (str) Where the finished array goes (without the format's suffix; we add it).
+        :param serializer: (JsonSerializer) The output format. Defaults to plain JSON.
+        """
+        self.serializer = serializer or serializers.JsonSerializer()
+        self.file_name = file_name + self.serializer.suffix
+        self.temp_name = self.file_name + '.tmp'
+        self.count = 0  # items written so far
+        self.bytes_written = 0  # bytes encoded so far (before any compression)
+        self.file_bytes = None  # the finished file's size, after close()
+        self._file = open(self.temp_name, 'wb')
+        self._stream = self.serializer.wrap(self._file)
+
+    def write(self, item):
+        """
+        :param item: A JSON-ready value: the array's next item.
+        :return: (int, int) The byte offset and length of the item's encoding (before any compression).
+        """
+        encoded = self.serializer.dumps(item)
+        self._write(self.serializer.array_separator if self.count else self.serializer.array_start)
+        self._write(encoded)
+        self.count += 1
+        return self.bytes_written - len(encoded), len(encoded)
+
+    def _write(self, data):
+        self._stream.write(data)
+        self.bytes_written += len(data)
+
+    def close(self):
+        """
+        Finish the array, flush it to disk, and swap it in for the target.
+        :return: None
+        """
+        if not self.count:
+            self._write(self.serializer.array_start)
+        self._write(self.serializer.array_end)
+        self.serializer.finish(self._stream)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.temp_name, self.file_name)
+        self.file_bytes = os.path.getsize(self.file_name)
+
+
+def add_sentiment(texts, processes=None, chunk_size=None):
+    """
+    Calculates sentiment for a text using VaderSentiment as a sentiment calculation between -1 and 1 (see
+    score_sentiment). For sentence-level sentiment, from the sentences that Topic already found, see
+    Topic.add_sentiment.
+    :param texts: (DataFrame) Our texts, with a 'text' column.
+    :param processes, chunk_size: See score_sentiment.
+    :return: No explicit return. Adds (or updates) texts['sentiment'] (the compound score).
+    """
+    # (Assigning to a row from iterrows() only changes a copy; a whole column sticks.)
+    texts['sentiment'] = [score[0] for score in score_sentiment(texts['text'].tolist(), processes, chunk_size)]
+
+
+def score_sentiment(raw_texts, processes=None, chunk_size=None, what='texts'):
     """
-    Calculates sentiment for a text using VaderSentiment as a sentiment calculation between -1 and 1.
-    :param texts: A dict of texts: {text_id: {text: 'abc', title: 'xyz'}}
-    :return: No explicit return. Adds (or updates) a sentiment to texts:
-        {text_id: {text: 'abc', title: 'xyz', sentiment: 0}}
+    Score many texts with VADER. Scores we've worked out before come from our sentiment cache (if
+    config.SENTIMENT_CACHE). VADER scores one text at a time in pure Python, so we hand chunks of the rest to a pool
+    of worker processes.
+    :param raw_texts: (list of str) The texts (or sentences) to score.
+    :param processes: (int) Worker processes to use; 1 scores in this process, -1 uses every core. Defaults to
+        config.SENTIMENT_PROCESSES.
+    :param chunk_size: (int) Texts per chunk handed to a worker. Defaults to config.SENTIMENT_CHUNK_SIZE.
+    :param what: (str) What we're scoring, for the run log.
+    :return: (list) (compound, pos, neg, neu) for each text.
     """
-    analyzer = SentimentIntensityAnalyzer()
-    # df_texts['sentiment'] = analyzer.polarity_scores(df_texts['text'].str)
+    start_time = time.time()
+    processes = config.SENTIMENT_PROCESSES if processes is None else processes
+    processes = multiprocessing.cpu_count() if processes == -1 else processes
+    chunk_size = chunk_size or config.SENTIMENT_CHUNK_SIZE
+
+    if config.SENTIMENT_CACHE:
+        cache = SentimentCache(analyzer_version(SentimentIntensityAnalyzer()),
+                               config.MODEL_DIR + 'sentiment_cache.sqlite')
+        keys = [cache.key(raw_text) for raw_text in raw_texts]
+        scores = cache.get_many(keys)  # {key: (compound, pos, neg, neu)}
+    else:
+        cache = None
+        keys = raw_texts
+        scores = {}
+
+    # Score each distinct text that we don't have scores for yet.
+    to_score = list({key: raw_text for key, raw_text in zip(keys, raw_texts) if key not in scores}.items())
+    chunks = [[raw_text for _, raw_text in to_score[i:i + chunk_size]] for i in range(0, len(to_score), chunk_size)]
+    if processes > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(processes, len(chunks)), _start_sentiment_worker) as pool:
+            new_scores = list(itertools.chain.from_iterable(pool.map(_score_sentiment, chunks)))
+    else:
+        _start_sentiment_worker()
+        new_scores = list(itertools.chain.from_iterable(_score_sentiment(chunk) for chunk in chunks))
+    new_scores = {key: score for (key, _), score in zip(to_score, new_scores)}
+    scores.update(new_scores)
+
+    if cache:
+        cache.put_many(new_scores)
+        cache.close()
+        print('Sentiment cache: {:,} hits, {:,} misses ({:.0%} hit rate)'.format(
+            cache.hits, cache.misses, cache.hits / max(cache.hits + cache.misses, 1)))
+
+    seconds = time.time() - start_time
+    print('Scored sentiment for {:,} {} ({:,} new) in {:.1f}s: {:,.0f} {}/sec'.format(
+        len(keys), what, len(new_scores), seconds, len(keys) / max(seconds, 1e-9), what))
+    return [scores[key] for key in keys]
+
+
+# Each worker process builds its own analyzer once (see add_sentiment), rather than receiving it with every chunk.
+_analyzer = None
+
+
+def _start_sentiment_worker():
+    global _analyzer
+    if _analyzer is None:
+        _analyzer = SentimentIntensityAnalyzer()
+
+
+def _score_sentiment(raw_texts):
+    scores = [_analyzer.polarity_scores(raw_text) for raw_text in raw_texts]
+    return [(score['compound'], score['pos'], score['neg'], score['neu']) for score in scores]
+
+
+class ShardWriter(object):
+    """
+    Write items into a series of arrays (shards) of about shard_bytes each, plus an index of where every item is, so a
+    reader can fetch one item with a single range read instead of loading everything:
+        XYZ-Texts-000.txt, XYZ-Texts-001.txt, ...: [item, item, ...]
+        XYZ-Texts-Index.txt: {"shards": ["XYZ-Texts-000.txt", ...], "texts": {item id: [shard, byte offset, length]}}
+    Each shard (and the index, written last) replaces its old file only when it's complete. The index is always
+    plain JSON; shards can be plain JSON or MessagePack (compressed shards couldn't be read by range).
+    """
+
+    def __init__(self, base_name, shard_bytes, serializer=None, key='id'):
+        """
+        :param base_name: (str) The path that shard and index names start with, e.g., 'Data/Matthew-Texts'.
+        :param shard_bytes: (int) Start a new shard once the current one reaches this size.
+        :param serializer: (JsonSerializer) The shards' format. Defaults to plain JSON.
+        :param key: (str) The item field that the index is keyed by.
+        """
+        self.base_name = base_name
+        self.shard_bytes = shard_bytes
+        self.serializer = serializer or serializers.JsonSerializer()
+        assert not self.serializer.compressed, 'Shards are read by byte range, so they can\'t be compressed.'
+        self.key = key
+        self.shards = []  # shard file names (without their folder)
+        self.index = {}  # {item id: [shard, byte offset, length]}
+        self.count = 0
+        self.file_bytes = 0  # the size of every finished shard, plus the index
+        self._writer = None
+
+    def write(self, item):
+        """
+        :param item: (dict) A JSON-ready item with a self.key field.
+        :return: None
+        """
+        if self._writer is None or self._writer.bytes_written >= self.shard_bytes:
+            self._close_shard()
+            self._writer = ArrayWriter('{}-{:03d}.txt'.format(self.base_name, len(self.shards)), self.serializer)
+            self.shards.append(os.path.basename(self._writer.file_name))
+        offset, length = self._writer.write(item)
+        self.index[item[self.key]] = [len(self.shards) - 1, offset, length]
+        self.count += 1
+
+    def _close_shard(self):
+        if self._writer is not None:
+            self._writer.close()
+            self.file_bytes += self._writer.file_bytes
+            self._writer = None
+
+    def close(self):
+        """
+        Finish the last shard, write the index, and remove shards left over from an earlier, bigger export.
+        :return: None
+        """
+        self._close_shard()
+        index_json = json.dumps({'shards': self.shards, 'texts': self.index})
+        with open(self.base_name + '-Index.txt.tmp', 'w') as file:
+            file.write(index_json)
+        os.replace(self.base_name + '-Index.txt.tmp', self.base_name + '-Index.txt')
+        self.file_bytes += len(index_json)
 
-    for index, row in texts.iterrows():
-        sentiment = analyzer.polarity_scores(row['text'])
-        row['sentiment'] = sentiment['compound']
+        for file_name in glob.glob(glob.escape(self.base_name) + '-[0-9][0-9][0-9].txt*'):
+            if os.path.basename(file_name) not in self.shards:
+                os.remove(file_name)
@@ -8,3 +8,41 @@ INPUT_DIR = 'Input/'  # Files that we need to run our models (e.g., stopwords)
 MODEL_DIR = 'Model/'  # We should save our models here for re-use
 # OUTPUT_DIR = 'Output/'
 OUTPUT_DIR = r'/Users/drichards/Documents/Coding/d3Tutorial/Data/'  #
+
+# LANGUAGE MODEL
+SPACY_MODEL = 'en'  # The spaCy model (or shortcut link) to load
+NLP_FEATURES = {'pos', 'lemma', 'dep', 'ner'}  # Token features we read; components that supply none aren't loaded
+
+# TOKENIZING
+TOKENIZE_BATCH_SIZE = 100  # Texts per spaCy nlp.pipe batch
+TOKENIZE_PROCESSES = -1  # Worker processes for nlp.pipe; -1 uses every core
+DOC_CACHE_MAX_BYTES = 500 * 1024 * 1024  # Size cap for parsed docs cached in MODEL_DIR; 0 turns the cache off
+
+# SENTIMENT
+SENTIMENT_PROCESSES = -1  # Worker processes for VADER sentiment scoring (common.add_sentiment); -1 uses every core
+SENTIMENT_CHUNK_SIZE = 2000  # Texts per chunk handed to a sentiment worker
+SENTIMENT_CACHE = True  # Cache sentiment scores in MODEL_DIR (by text hash + VADER version), so re-runs skip them
+SENTIMENT_BY_SENTENCE = False  # Score each sentence of Topic's parse (topics get sentiment too), not whole texts
+
+# COUNTING
+COUNT_PROCESSES = 1  # Worker processes for topic and ngram counting (detect_ngram); -1 uses every core
+COUNT_SHARDS_PER_PROCESS = 4  # Shards of texts per counting process, so one slow shard doesn't hold up the rest
+MAX_VERBATIMS = 10  # Verbatims (surface forms) kept per topic and ngram, most common first
+SAVE_COUNTS = True  # Save raw counts to MODEL_DIR, so Topic.from_counts can re-prune without re-running
+COUNT_MEMORY_BYTES = 0  # Memory for raw counts; past it, they spill to an SQLite file in MODEL_DIR. 0: no limit
+COUNT_CHUNK_TEXTS = 10000  # Texts counted at a time when counting within a memory budget (or approximately)
+
+# APPROXIMATE COUNTING (for corpora too large to count every ngram exactly; see ngram_engine.count_approximate)
+APPROX_COUNTING = False  # Count ngrams approximately, in a fixed memory budget (detect_ngram's default)
+APPROX_SKETCH_WIDTH = 2 ** 20  # Count-min sketch counters per row (a power of 2); error shrinks as this grows
+APPROX_SKETCH_DEPTH = 4  # Count-min sketch rows; confidence in the error bound is 1 - e^-depth
+APPROX_PROMOTE_TEXT_COUNT = 2  # An ngram is tracked exactly once the sketch puts it in this many texts
+APPROX_MAX_CANDIDATES = 500000  # The most ngrams tracked exactly; those in the fewest texts are evicted past this
+
+# EXPORT
+OUTPUT_FORMAT = 'json'  # 'json', 'json.gz', 'json.zst' (zstandard package) or 'msgpack' (msgpack package)
+HTML_CARDS = 'eager'  # 'eager': store every text's card; 'lazy': serve them (card_renderer.py); 'none': UI builds them
+CARD_SERVER_PORT = 8765  # Where card_renderer.py serves cards, in 'lazy' mode
+DELTA_EXPORTS = False  # Export only what changed since the last run (plus a manifest), not all of XYZ-Topics/Texts
+DELTA_MAX_CHAIN = 7  # With DELTA_EXPORTS, write a full snapshot again after this many deltas
+TEXTS_SHARD_BYTES = 0  # Split XYZ-Texts.txt into shards of about this size, plus an index for range reads; 0: one file
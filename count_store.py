@@ -0,0 +1,302 @@
+"""
+Counts that don't fit in memory. For a very large corpus (a year of daily feeds, say), the raw topic, ngram and
+subtopic counts outgrow memory long before the texts do, since most distinct ngrams occur only once. So we count a
+chunk of texts at a time and, whenever the counts we're holding pass our memory budget, spill them into a CountStore:
+an SQLite file, filled with batched upserts (counts add up, first appearances keep the earliest, and (item, text) pairs
+we already have are ignored).
+
+Selecting topics and ngrams then runs as queries over the store. Only the topics and ngrams that can pass our
+thresholds come back into memory, as an ordinary CountSnapshot, so the rest of Topic works just as it does on counts
+that never left memory.
+"""
+
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+import ngram_engine
+
+
+# Ngrams are keyed by their norm ids as little-endian int32 bytes (so a key also tells us the ngram's length).
+_SCHEMA = """
+CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE topic (lemma INTEGER PRIMARY KEY, count INTEGER, first INTEGER);
+CREATE TABLE topic_text (lemma INTEGER, text INTEGER, PRIMARY KEY (lemma, text)) WITHOUT ROWID;
+CREATE TABLE topic_verbatim (lemma INTEGER, lower INTEGER, count INTEGER, PRIMARY KEY (lemma, lower)) WITHOUT ROWID;
+CREATE TABLE ngram (key BLOB PRIMARY KEY, n INTEGER, count INTEGER, first INTEGER, spaced INTEGER) WITHOUT ROWID;
+CREATE TABLE ngram_text (key BLOB, text INTEGER, PRIMARY KEY (key, text)) WITHOUT ROWID;
+CREATE TABLE ngram_verbatim (key BLOB, lowers BLOB, count INTEGER, PRIMARY KEY (key, lowers)) WITHOUT ROWID;
+CREATE TABLE subtopic (key BLOB, lemma INTEGER, text INTEGER, PRIMARY KEY (key, lemma, text)) WITHOUT ROWID;
+"""
+
+
+def count_within_budget(tokens, stop, skip, nounish, max_n, window, memory_bytes, file_name, processes=1,
+                        chunk_texts=10000):
+    """
+    Count topics and ngrams a chunk of texts at a time, spilling everything we're holding into a CountStore whenever
+    it takes more than memory_bytes.
+
+    :param tokens, stop, skip, nounish, max_n, window: See ngram_engine.CountContext.
+    :param memory_bytes: (int) How much memory the counts we hold between spills may take.
+    :param file_name: (str) Where to keep the store, if we need one (an old one there is replaced).
+    :param processes: (int) Worker processes that count chunks; 1 counts in this process, -1 uses every core.
+    :param chunk_texts: (int) About how many texts we count at a time.
+    :return: (TopicCounts, NgramCounts, CountStore) The counts and None if they stayed within budget; otherwise
+        None, None and the store that holds all of them.
+    """
+    topic_counts, ngram_counts, store = None, None, None
+    for topic_part, ngram_part in ngram_engine.count_chunks(tokens, stop, skip, nounish, max_n, window,
+                                                            ngram_engine.chunk_bounds(tokens, chunk_texts),
+                                                            processes):
+        if topic_counts is None:
+            topic_counts, ngram_counts = topic_part, ngram_part
+        else:
+            topic_counts = ngram_engine.TopicCounts.merge([topic_counts, topic_part])
+            ngram_counts = ngram_engine.NgramCounts.merge([ngram_counts, ngram_part])
+
+        if topic_counts.nbytes + ngram_counts.nbytes > memory_bytes:
+            if store is None:
+                store = CountStore(file_name, tokens.strings, len(tokens), sorted(ngram_counts.rows, reverse=True))
+            store.add(topic_counts, ngram_counts)
+            topic_counts, ngram_counts = None, None
+
+    if store is None:
+        return topic_counts, ngram_counts, None
+    if topic_counts is not None:
+        store.add(topic_counts, ngram_counts)
+    return None, None, store
+
+
+class CountStore(object):
+    """
+    Raw (unpruned) topic and ngram counts in an SQLite file, with the same contents as a TopicCounts plus an
+    NgramCounts.
+    """
+
+    def __init__(self, file_name, strings=None, text_count=None, lengths=None):
+        """
+        Open a store. With strings, text_count and lengths, start a new, empty store (replacing any old file).
+
+        :param file_name: (str) The store's path.
+        :param strings: (list of str) The token table's strings.
+        :param text_count: (int) How many texts are in the corpus.
+        :param lengths: (list of int) The ngram lengths we count, longest first.
+        """
+        self.file_name = file_name
+        self.spills = 0
+        self._snapshot = None  # (settings, CountSnapshot) from our last snapshot()
+
+        if strings is not None:
+            folder = os.path.dirname(file_name)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        self.db = sqlite3.connect(file_name)
+        if strings is not None:
+            self.db.executescript(_SCHEMA)
+            self.set_meta(strings=strings, text_count=text_count, lengths=lengths, text_ids=[], meta={})
+
+        self.strings = self.get_meta('strings')
+        self.string_ids = {string: i for i, string in enumerate(self.strings)}
+        self._space_ids = np.array([i for i, string in enumerate(self.strings) if ' ' in string], dtype=np.int32)
+
+    def set_meta(self, **values):
+        """
+        Save JSON-ready details with the counts (e.g., text_ids and the run's meta; see CountSnapshot).
+        :param values: {name: value}
+        :return: None
+        """
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                [(name, json.dumps(value)) for name, value in values.items()])
+        self._snapshot = None
+
+    def get_meta(self, name):
+        """
+        :param name: (str) A name given to set_meta.
+        :return: The value saved under name.
+        """
+        return json.loads(self.db.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()[0])
+
+    @property
+    def nbytes(self):
+        """
+        :return: (int) The size of the store's file.
+        """
+        return os.path.getsize(self.file_name)
+
+    def add(self, topic_counts, ngram_counts):
+        """
+        Add the counts for some texts to the store, as a single transaction of batched upserts.
+        :param topic_counts: (TopicCounts) Counts for texts we haven't added yet.
+        :param ngram_counts: (NgramCounts) Ngram counts for the same texts.
+        :return: None
+        """
+        text_count = ngram_counts.text_count
+        keys = _keys(ngram_counts.rows)  # one per node
+        spaced = np.concatenate([np.zeros(0, dtype=bool)] + [np.isin(ngram_counts.rows[n], self._space_ids).any(axis=1)
+                                                             for n in sorted(ngram_counts.rows, reverse=True)])
+
+        with self.db:
+            self.db.executemany('INSERT INTO topic VALUES (?, ?, ?) ON CONFLICT (lemma) DO UPDATE SET '
+                                'count = count + excluded.count, first = MIN(first, excluded.first)',
+                                zip(topic_counts.lemmas.tolist(), topic_counts.count.tolist(),
+                                    topic_counts.first.tolist()))
+            self.db.executemany('INSERT OR IGNORE INTO topic_text VALUES (?, ?)', topic_counts.text_pairs.tolist())
+            self.db.executemany('INSERT INTO topic_verbatim VALUES (?, ?, ?) ON CONFLICT (lemma, lower) DO UPDATE SET '
+                                'count = count + excluded.count',
+                                [row + [count] for row, count in zip(topic_counts.verbatim_pairs.tolist(),
+                                                                     topic_counts.verbatim_counts.tolist())])
+
+            self.db.executemany('INSERT INTO ngram VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET '
+                                'count = count + excluded.count, first = MIN(first, excluded.first)',
+                                zip(keys, ngram_counts.node_n.tolist(), ngram_counts.node_count.tolist(),
+                                    ngram_counts.node_first.tolist(), spaced.tolist()))
+            self.db.executemany('INSERT OR IGNORE INTO ngram_text VALUES (?, ?)',
+                                ((keys[pair // text_count], pair % text_count)
+                                 for pair in ngram_counts.text_pairs.tolist()))
+            for n, rows in ngram_counts.verbatim_rows.items():
+                self.db.executemany('INSERT INTO ngram_verbatim VALUES (?, ?, ?) ON CONFLICT (key, lowers) DO UPDATE '
+                                    'SET count = count + excluded.count',
+                                    zip([keys[node] for node in rows[:, 0].tolist()], _keys({n: rows[:, 1:]}),
+                                        ngram_counts.verbatim_counts[n].tolist()))
+            self.db.executemany('INSERT OR IGNORE INTO subtopic VALUES (?, ?, ?)',
+                                ((keys[node], lemma, text) for lemma, node, text in ngram_counts.subtopics.tolist()))
+
+        self.spills += 1
+        self._snapshot = None
+
+    def snapshot(self, min_topic_count=5, min_text_id_count=4):
+        """
+        Query the store for every topic and ngram that can pass these thresholds (see
+        Topic.select_topics_and_ngrams), and load only those. Ngrams spelled like a merged entity (see
+        NgramCounts._canonical_nodes) come along whatever their counts, since they're counted together.
+
+        :param min_topic_count: (int) The fewest times a topic must occur.
+        :param min_text_id_count: (int) The fewest texts a topic or ngram must occur in.
+        :return: (CountSnapshot) Counts for just those topics and ngrams; they select the same topics and ngrams (with
+            the same counts) as the full counts would.
+        """
+        settings = (min_topic_count, min_text_id_count)
+        if self._snapshot is not None and self._snapshot[0] == settings:
+            return self._snapshot[1]
+
+        db = self.db
+        db.executescript('DROP TABLE IF EXISTS temp.wanted_topic; DROP TABLE IF EXISTS temp.wanted_key;'
+                         'CREATE TEMP TABLE wanted_topic (lemma INTEGER PRIMARY KEY);'
+                         'CREATE TEMP TABLE wanted_key (key BLOB PRIMARY KEY) WITHOUT ROWID;')
+        db.execute('INSERT INTO wanted_topic SELECT lemma FROM topic WHERE count >= ? AND lemma IN '
+                   '(SELECT lemma FROM topic_text GROUP BY lemma HAVING COUNT(*) >= ?)', settings)
+        db.execute('INSERT OR IGNORE INTO wanted_key SELECT key FROM ngram_text GROUP BY key HAVING COUNT(*) >= ?',
+                   (min_text_id_count,))
+        db.execute('INSERT OR IGNORE INTO wanted_key SELECT key FROM ngram WHERE spaced = 1')
+        spellings = []
+        for key, in db.execute('SELECT key FROM ngram WHERE spaced = 1').fetchall():
+            words = ' '.join(self.strings[i] for i in np.frombuffer(key, dtype='<i4').tolist()).split(' ')
+            if all(word in self.string_ids for word in words):
+                spellings.append((np.array([self.string_ids[word] for word in words], dtype='<i4').tobytes(),))
+        db.executemany('INSERT OR IGNORE INTO wanted_key SELECT key FROM ngram WHERE key = ?', spellings)
+
+        snapshot = ngram_engine.CountSnapshot(self._load_topics(), self._load_ngrams(), self.strings,
+                                              self.get_meta('text_ids'), self.get_meta('meta'))
+        self._snapshot = settings, snapshot
+        return snapshot
+
+    def _load_topics(self):
+        """
+        :return: (TopicCounts) The counts of the topics in wanted_topic.
+        """
+        topics = ngram_engine.TopicCounts.__new__(ngram_engine.TopicCounts)
+        lemmas, topics.count, topics.first = _columns(self.db.execute(
+            'SELECT lemma, count, first FROM topic JOIN wanted_topic USING (lemma) ORDER BY lemma'), 3)
+        topics.lemmas = lemmas
+        topics.text_pairs = np.column_stack(_columns(self.db.execute(
+            'SELECT lemma, text FROM topic_text JOIN wanted_topic USING (lemma) ORDER BY lemma, text'), 2))
+        verbatim_lemmas, lowers, topics.verbatim_counts = _columns(self.db.execute(
+            'SELECT lemma, lower, count FROM topic_verbatim JOIN wanted_topic USING (lemma) ORDER BY lemma, lower'), 3)
+        topics.verbatim_pairs = np.column_stack([verbatim_lemmas, lowers])
+        return topics
+
+    def _load_ngrams(self):
+        """
+        :return: (NgramCounts) The counts of the ngrams in wanted_key, numbered the way NgramCounts numbers them.
+        """
+        ngrams = ngram_engine.NgramCounts.__new__(ngram_engine.NgramCounts)
+        ngrams.text_count = text_count = self.get_meta('text_count')
+        ngrams.rows, ngrams.node_offset, ngrams.verbatim_rows, ngrams.verbatim_counts = {}, {}, {}, {}
+
+        found = {n: [] for n in self.get_meta('lengths')}  # {n: [(key, count, first)]}
+        for key, n, count, first in self.db.execute('SELECT key, n, count, first FROM ngram JOIN wanted_key '
+                                                    'USING (key)'):
+            found[n].append((key, count, first))
+
+        # Node ids: by length (longest first), then by the ngram's norm ids, as in NgramCounts.
+        node_of = {}  # {key: node}
+        node_n, node_count, node_first = [], [], []
+        node_total = 0
+        for n in sorted(found, reverse=True):
+            keys = [key for key, _, _ in found[n]]
+            rows = np.frombuffer(b''.join(keys), dtype='<i4').reshape(-1, n).astype(np.int32)
+            order = np.lexsort(rows.T[::-1])
+            ngrams.rows[n] = rows[order]
+            ngrams.node_offset[n] = node_total
+            for node, i in enumerate(order.tolist(), node_total):
+                node_of[keys[i]] = node
+                node_n.append(n)
+                node_count.append(found[n][i][1])
+                node_first.append(found[n][i][2])
+            node_total += len(keys)
+        ngrams.node_n = np.array(node_n, dtype=np.int64)
+        ngrams.node_count = np.array(node_count, dtype=np.int64)
+        ngrams.node_first = np.array(node_first, dtype=np.int64)
+
+        ngrams.text_pairs = np.unique(np.array(
+            [node_of[key] * text_count + text for key, text in
+             self.db.execute('SELECT key, text FROM ngram_text JOIN wanted_key USING (key)')], dtype=np.int64))
+
+        verbatims = {n: [] for n in found}  # {n: [[node, lower ids..., count]]}
+        for key, lowers, count in self.db.execute('SELECT key, lowers, count FROM ngram_verbatim JOIN wanted_key '
+                                                  'USING (key)'):
+            ids = np.frombuffer(lowers, dtype='<i4').tolist()
+            verbatims[len(ids)].append([node_of[key]] + ids + [count])
+        for n, rows in verbatims.items():
+            rows = np.array(rows, dtype=np.int64).reshape(-1, n + 2)
+            rows = rows[np.lexsort(rows[:, :-1].T[::-1])]
+            ngrams.verbatim_rows[n], ngrams.verbatim_counts[n] = rows[:, :-1], rows[:, -1]
+
+        subtopics = np.array([[lemma, node_of[key], text] for key, lemma, text in self.db.execute(
+            'SELECT key, lemma, text FROM subtopic JOIN wanted_key USING (key) WHERE lemma IN '
+            '(SELECT lemma FROM wanted_topic)')], dtype=np.int64).reshape(-1, 3)
+        ngrams.subtopics = subtopics[np.lexsort(subtopics.T[::-1])]
+        ngrams._merged = None
+        return ngrams
+
+    def close(self):
+        """
+        :return: None
+        """
+        self.db.close()
+
+
+def _keys(rows):
+    """
+    :param rows: (dict) {n: (np.array, 2-d) rows of n ids}
+    :return: (list of bytes) Every row's ids as little-endian int32 bytes: longest rows first, then in row order.
+    """
+    keys = []
+    for n in sorted(rows, reverse=True):
+        keys += np.ascontiguousarray(rows[n], dtype='<i4').view('V{}'.format(4 * n)).reshape(-1).tolist()
+    return keys
+
+
+def _columns(cursor, width):
+    """
+    :param cursor: (sqlite3.Cursor) A query for width integer columns.
+    :param width: (int) The number of columns.
+    :return: (list of np.array of int64) One array per column.
+    """
+    rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, width)
+    return [rows[:, i] for i in range(width)]
@@ -0,0 +1,156 @@
+"""
+Delta exports. Daily runs mostly re-export the same texts and topics, so rather than a full XYZ-Texts.txt (or
+XYZ-Topics.txt) every day, an export can write just what changed since the one before:
+    XYZ-Texts-Delta-<base>-<version>.txt: {"base": version, "version": version, "key": "id", "order": [key, ...],
+        "added": [record, ...], "changed": [record, ...], "removed": [key, ...], "meta": {...}}
+    XYZ-Texts-Manifest.txt: {"version": version, "key": "id", "snapshot": {"file": ..., "version": version},
+        "deltas": [{"file": ..., "base": version, "version": version, "added": 2, "changed": 5, "removed": 0}, ...]}
+A record has changed when its content hash has. To patch its cached copy, the UI finds the delta whose base is the
+cached version and applies it and every later one, in order (upsert added and changed records, drop removed keys, then
+put records in order and replace meta); if none matches, it loads the snapshot and applies them all. We still write a
+full snapshot on the first run, on demand, and once the chain of deltas gets long.
+"""
+
+import hashlib
+import json
+import os
+
+import config
+import serializers
+
+
+def record_hash(record):
+    """
+    :param record: (dict) A JSON-ready record.
+    :return: (str) A hash of its content (the same however its fields are ordered).
+    """
+    return hashlib.sha1(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class DeltaExport(object):
+    """
+    Compare one export's records, as they're written, against the previous export's, and save the difference.
+    """
+
+    def __init__(self, name, key):
+        """
+        :param name: (str) The export's name, e.g., 'Matthew-Texts'. It names the manifest and deltas (in
+            config.OUTPUT_DIR) and our record of the last export's hashes (in config.MODEL_DIR).
+        :param key: (str) The record field that identifies a record.
+        """
+        self.name = name
+        self.key = key
+        self.manifest_name = config.OUTPUT_DIR + name + '-Manifest.txt'
+        self.state_name = config.MODEL_DIR + name + '-Hashes.txt'
+        self.manifest = _read_json(self.manifest_name)
+        state = _read_json(self.state_name)
+
+        # We can only write a delta against the version that the manifest ends on (if a run died between saving the
+        # two, they won't match, and the next export starts over from a snapshot).
+        if self.manifest and state and state['version'] == self.manifest['version'] and state['key'] == key:
+            self.base = state['version']
+            self.old_hashes = state['hashes']
+        else:
+            self.base = None
+            self.old_hashes = {}
+        self.hashes = {}  # {key: hash} for this export, in order
+        self.added = []
+        self.changed = []
+
+    def needs_snapshot(self, max_chain=None):
+        """
+        :param max_chain: (int) The most deltas to chain after a snapshot. Defaults to config.DELTA_MAX_CHAIN.
+        :return: (bool) Must this export be a full snapshot? (There's nothing to compare to, or the chain is full.)
+        """
+        max_chain = config.DELTA_MAX_CHAIN if max_chain is None else max_chain
+        return self.base is None or len(self.manifest['deltas']) >= max_chain
+
+    def add(self, record):
+        """
+        :param record: (dict) The export's next record. We only hold on to it if it's new or changed.
+        :return: None
+        """
+        key = record[self.key]
+        digest = record_hash(record)
+        self.hashes[key] = digest
+        old = self.old_hashes.get(key)
+        if old is None:
+            self.added.append(record)
+        elif old != digest:
+            self.changed.append(record)
+
+    def version(self, meta=None):
+        """
+        :param meta: (dict) The export's fields besides its records (e.g., a topic model's runDate), if any.
+        :return: (str) A hash of the whole export: its records' keys and hashes, in order, plus meta.
+        """
+        return record_hash({'records': list(self.hashes.items()), 'meta': meta})
+
+    def save(self, snapshot_file=None, serializer=None, meta=None):
+        """
+        Write the delta (unless this export is a snapshot, or nothing changed), then the manifest and our hashes.
+        :param snapshot_file: (str) If we just wrote a full export, its file name (in config.OUTPUT_DIR).
+        :param serializer: (JsonSerializer) The delta's format. Defaults to plain JSON.
+        :param meta: (dict) The export's fields besides its records; deltas always carry them whole.
+        :return: (str) The delta's file name (in config.OUTPUT_DIR), or None if we didn't write one.
+        """
+        serializer = serializer or serializers.JsonSerializer()
+        version = self.version(meta)
+        removed = [key for key in self.old_hashes if key not in self.hashes]
+        delta_file = None
+
+        if snapshot_file:
+            for delta in (self.manifest or {}).get('deltas', []):  # the old chain is no use without its snapshot
+                if os.path.exists(config.OUTPUT_DIR + delta['file']):
+                    os.remove(config.OUTPUT_DIR + delta['file'])
+            self.manifest = {'version': version, 'key': self.key,
+                             'snapshot': {'file': snapshot_file, 'version': version}, 'deltas': []}
+        elif version == self.base:
+            print('No changes to {} since the last export'.format(self.name))
+            return None
+        else:
+            assert self.base is not None, 'There\'s no previous export to compare to; save a snapshot instead.'
+            # Named by both versions: an export can return to an earlier version, and each link keeps its own file.
+            delta_file = '{}-Delta-{}-{}.txt'.format(self.name, self.base[:8], version[:8])
+            file_name, size = serializers.save({'base': self.base, 'version': version, 'key': self.key,
+                                                'order': list(self.hashes), 'added': self.added,
+                                                'changed': self.changed, 'removed': removed, 'meta': meta},
+                                               config.OUTPUT_DIR + delta_file, serializer)
+            delta_file = os.path.basename(file_name)
+            self.manifest['version'] = version
+            self.manifest['deltas'].append({'file': delta_file, 'base': self.base, 'version': version,
+                                            'added': len(self.added), 'changed': len(self.changed),
+                                            'removed': len(removed)})
+            print('Exported the changes to {}: {:,} added, {:,} changed, {:,} removed ({}, {:,.1f} MB)'.format(
+                self.name, len(self.added), len(self.changed), len(removed), delta_file, size / 1024 / 1024))
+
+        # The manifest goes first: if we die before saving our hashes, the next export is a snapshot (see __init__).
+        _write_json(self.manifest, self.manifest_name)
+        _write_json({'version': version, 'key': self.key, 'hashes': self.hashes}, self.state_name)
+        self.base = version
+        return delta_file
+
+
+def _read_json(file_name):
+    """
+    :param file_name: (str) A JSON file.
+    :return: Its value, or None if it doesn't exist.
+    """
+    try:
+        with open(file_name, 'r') as file:
+            return json.load(file)
+    except IOError:
+        return None
+
+
+def _write_json(value, file_name):
+    """
+    Write value to a temp file, then swap it in, so readers never see half a file.
+    :param value: A JSON-ready value.
+    :param file_name: (str) Where it goes.
+    :return: None
+    """
+    folder = os.path.dirname(file_name)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    serializers.save(value, file_name, serializers.JsonSerializer())
@@ -0,0 +1,187 @@
+"""
+A persistent, content-addressed cache of parsed spaCy docs. Parsing is the slowest step of a run, and most re-runs
+(tweaking prune_topics_and_adopt, re-exporting) parse the exact same texts again. Docs are keyed by a hash of the text
+plus everything else that shapes the parse: the spaCy model and version, known_entities.txt and stop_words.txt.
+
+Docs are stored in "packs" (one spaCy DocBin per run's worth of new docs), so we read each pack only once, however many
+of its docs we need. When the cache grows past its size cap, we evict the least recently used packs.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from spacy.attrs import ORTH
+from spacy.tokens import Doc, DocBin
+
+import config
+
+
+# The token attributes that Topic reads (HEAD and DEP rebuild the parse, including sentence boundaries).
+DOC_ATTRS = ['ORTH', 'LEMMA', 'TAG', 'POS', 'HEAD', 'DEP', 'ENT_IOB', 'ENT_TYPE']
+
+
+def file_hash(file_name):
+    """
+    Hash a file's contents, so that editing an input file (e.g., known_entities.txt) invalidates cached docs.
+    :param file_name: (str) The path to the file.
+    :return: (str) A hex digest; the digest of an empty string if the file doesn't exist.
+    """
+    try:
+        with open(file_name, 'rb') as file:
+            return hashlib.sha1(file.read()).hexdigest()
+    except IOError:
+        return hashlib.sha1(b'').hexdigest()
+
+
+class DocCache(object):
+    """
+    Save and load parsed spaCy docs, keyed by text hash + parse settings, with a size cap and LRU eviction.
+    """
+
+    def __init__(self, vocab, fingerprint, cache_dir=None, max_bytes=None):
+        """
+        Read the cache index (if we have one). Packs aren't read until we get() a doc from them.
+
+        :param vocab: (spaCy vocab) The vocab of the language model; docs are restored against it.
+        :param fingerprint: (list of str) Everything besides the text that changes a parse (model name and version,
+            input file hashes). It's folded into every key.
+        :param cache_dir: (str) Where the packs and index live. Defaults to config.MODEL_DIR + 'doc_cache/'.
+        :param max_bytes: (int) The size cap for all packs. Defaults to config.DOC_CACHE_MAX_BYTES.
+        """
+        self.vocab = vocab
+        self.fingerprint = '|'.join(fingerprint)
+        self.cache_dir = cache_dir or config.MODEL_DIR + 'doc_cache/'
+        self.max_bytes = config.DOC_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._packs = {}  # {pack_name: DocBin} for packs we've read this run
+        self._pending = DocBin(attrs=DOC_ATTRS)  # new docs waiting for flush()
+        self._pending_keys = []
+
+        # index = {'docs': {key: [pack_name, position]}, 'packs': {pack_name: {'bytes': 123, 'used': 1500000000.0}}}
+        try:
+            with open(self.cache_dir + 'index.json', 'r') as file:
+                self.index = json.load(file)
+        except (IOError, ValueError):
+            self.index = {'docs': {}, 'packs': {}}
+
+    def key(self, raw_text):
+        """
+        :param raw_text: (str) The exact text we'd hand to the language model.
+        :return: (str) The cache key for this text under our fingerprint.
+        """
+        return hashlib.sha1((self.fingerprint + '\n' + raw_text).encode('utf-8')).hexdigest()
+
+    def find(self, keys):
+        """
+        Check which keys we have docs for (an index lookup; no packs are read). Counts toward our hits and misses.
+        :param keys: (list of str) Cache keys (see key()).
+        :return: (set) The keys that we can get().
+        """
+        found = {key for key in keys if key in self.index['docs'] and
+                 os.path.exists(self.cache_dir + self.index['docs'][key][0])}
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def get(self, key):
+        """
+        Rebuild one cached doc. The first get() from a pack reads the whole pack (as compact arrays, not docs) and
+        keeps it for the other docs in it; each doc is only rebuilt when asked for, so we never hold them all at once.
+        :param key: (str) A key returned by find().
+        :return: (spaCy doc) The cached doc, or None if its pack can't be read.
+        """
+        pack_name, position = self.index['docs'][key]
+        if pack_name not in self._packs:
+            try:
+                with open(self.cache_dir + pack_name, 'rb') as file:
+                    doc_bin = DocBin().from_bytes(file.read())
+            except (IOError, ValueError):
+                return None
+            for string in doc_bin.strings:
+                self.vocab[string]
+            self._packs[pack_name] = doc_bin
+            self.index['packs'][pack_name]['used'] = time.time()
+
+        doc_bin = self._packs[pack_name]
+        tokens = doc_bin.tokens[position]
+        words = [self.vocab.strings[orth] for orth in tokens[:, doc_bin.attrs.index(ORTH)]]
+        return Doc(self.vocab, words=words, spaces=doc_bin.spaces[position]).from_array(doc_bin.attrs, tokens)
+
+    def add(self, key, doc):
+        """
+        Queue a newly parsed doc for the next pack. It's converted to compact arrays right away, so the doc itself
+        can be dropped.
+        :param key: (str) The doc's cache key.
+        :param doc: (spaCy doc) The processed doc.
+        :return: None
+        """
+        if self.max_bytes <= 0:
+            return
+        self._pending.add(doc)
+        self._pending.strings.update(token.lemma_ for token in doc)  # DocBin only saves the token texts on its own
+        self._pending_keys.append(key)
+
+    def flush(self):
+        """
+        Save queued docs as a single pack, evict old packs if we're over our size cap, and save the index (which also
+        records when we last used each pack).
+        :return: None
+        """
+        if self._pending_keys:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            data = self._pending.to_bytes()
+            pack_name = '{}.spacy'.format(hashlib.sha1(''.join(self._pending_keys).encode('utf-8')).hexdigest()[:16])
+            with open(self.cache_dir + pack_name, 'wb') as file:
+                file.write(data)
+
+            self.index['packs'][pack_name] = {'bytes': len(data), 'used': time.time()}
+            for position, key in enumerate(self._pending_keys):
+                self.index['docs'][key] = [pack_name, position]
+
+            self._pending = DocBin(attrs=DOC_ATTRS)
+            self._pending_keys = []
+            self._evict(keep=pack_name)
+
+        if self._packs or self.index['packs']:
+            self._save_index()
+
+    def _evict(self, keep):
+        """
+        Drop the least recently used packs until we're under max_bytes. We never evict the pack we just wrote.
+        :param keep: (str) The pack name to keep no matter what.
+        :return: None
+        """
+        total = sum(pack['bytes'] for pack in self.index['packs'].values())
+        for pack_name in sorted(self.index['packs'], key=lambda name: self.index['packs'][name]['used']):
+            if total <= self.max_bytes:
+                break
+            if pack_name == keep:
+                continue
+            total -= self.index['packs'][pack_name]['bytes']
+            self._drop_pack(pack_name)
+
+    def _drop_pack(self, pack_name):
+        """
+        Remove a pack file and every index entry that points into it.
+        :param pack_name: (str) The pack's file name.
+        :return: None
+        """
+        self.index['packs'].pop(pack_name, None)
+        self.index['docs'] = {key: value for key, value in self.index['docs'].items() if value[0] != pack_name}
+        try:
+            os.remove(self.cache_dir + pack_name)
+        except OSError:
+            pass
+
+    def _save_index(self):
+        """
+        Write the index to a temp file, then swap it in, so a crashed run never leaves a half-written index.
+        :return: None
+        """
+        temp_name = self.cache_dir + 'index.json.tmp'
+        with open(temp_name, 'w') as file:
+            json.dump(self.index, file)
+        os.replace(temp_name, self.cache_dir + 'index.json')
@@ -0,0 +1,131 @@
+"""
+Loads the spaCy language model on first use, once per process, and shares it between Topic and TopicBuilder.
+We only load the pipeline components that produce the token features we actually read (config.NLP_FEATURES); skipping
+a component saves its load time and its share of every parse.
+
+Also home to the doc post-processing that Topic and TopicBuilder share (KnownEntityMatcher, merge_entities).
+"""
+
+import time
+
+import spacy
+from spacy.matcher import PhraseMatcher
+from spacy.tokens import Span
+from spacy.util import filter_spans
+
+import config
+
+
+# The pipeline component that fills in each token feature we read.
+FEATURE_COMPONENTS = {'pos': 'tagger',  # token.pos
+                      'lemma': 'tagger',  # token.lemma_ (the lemmatizer keys off of the tagger's tags)
+                      'dep': 'parser',  # token.dep (we find punctuation with ss.punct), sentence boundaries
+                      'ner': 'ner'}  # token.ent_type
+
+# spaCy's built-in components that carry model weights. Anything here that no feature needs is disabled.
+MODEL_COMPONENTS = ['tagger', 'parser', 'ner', 'entity_linker', 'textcat']
+
+# Bump this when the post-processing below changes what a finished doc looks like; it retires cached docs.
+POSTPROCESS_VERSION = '1'
+
+_models = {}  # {frozenset of features: spaCy language model}
+
+
+def load(features=None):
+    """
+    Get the spaCy language model with just the components that features need. The first call for a set of features
+    loads the model; every later call in this process gets the same object back.
+
+    :param features: (iterable of str) Token features we'll read: any of 'pos', 'lemma', 'dep' and 'ner'. Defaults to
+        config.NLP_FEATURES.
+    :return: (spaCy Language) The loaded model.
+    """
+    features = frozenset(config.NLP_FEATURES if features is None else features)
+    assert features <= set(FEATURE_COMPONENTS), \
+        'NLP features must come from: {}.'.format(', '.join(sorted(FEATURE_COMPONENTS)))
+
+    if features not in _models:
+        needed = {FEATURE_COMPONENTS[feature] for feature in features}
+        start_time = time.time()
+        nlp = spacy.load(config.SPACY_MODEL,
+                         disable=[component for component in MODEL_COMPONENTS if component not in needed])
+        print('Loaded spaCy model "{}" ({}) in {:.1f}s'.format(config.SPACY_MODEL, ', '.join(nlp.pipe_names),
+                                                               time.time() - start_time))
+        _models[features] = nlp
+
+    return _models[features]
+
+
+def merge_entities(doc, entities, stop_words):
+    """
+    Join multi-word named entities into a single token; they nearly always refer to one thing (e.g., first name, last
+    name). A run starts at a proper-noun token (entity type in entities) and takes in each following token of the same
+    entity type, stopping at stop words and spaces. We collect every run first, then merge them all in one
+    retokenization, rather than merging a pair at a time (each merge rebuilds the token array).
+
+    :param doc: (spaCy doc) A parsed doc.
+    :param entities: (set) spaCy entity types that mark a proper noun.
+    :param stop_words: (set) Words that never join (or start) a merged entity.
+    :return: (spaCy doc) The same doc, with its entity runs merged.
+    """
+    def joinable(token):
+        return token.text.lower() not in stop_words and token.text not in ' '
+
+    runs = []
+    i = 0
+    while i < len(doc):
+        end = i + 1
+        if doc[i].ent_type in entities and joinable(doc[i]):
+            while end < len(doc) and doc[end].ent_type == doc[i].ent_type and joinable(doc[end]):
+                end += 1
+            if end - i > 1:
+                runs.append(doc[i:end])
+        i = end
+
+    with doc.retokenize() as retokenizer:
+        for run in runs:
+            retokenizer.merge(run)
+
+    return doc
+
+
+class KnownEntityMatcher(object):
+    """
+    Make sure that our known entities (known_entities.txt) are treated as named entities, even when the model's NER
+    misses them. The list is compiled once into a PhraseMatcher, so each doc gets a single pass no matter how many
+    names we know, and multi-word entries (written with underscores, e.g., john_the_baptist) match too.
+    """
+
+    def __init__(self, nlp, known_entities, entities, label='PERSON'):
+        """
+        :param nlp: (spaCy Language) The language model; we use its tokenizer so patterns split like our texts do.
+        :param known_entities: (iterable of str) Lower-case names; underscores join the words of a multi-word name.
+        :param entities: (set) spaCy entity types that already mark a proper noun. A match that the model has
+            labeled entirely with these types is left alone.
+        :param label: (str) The entity type we give to known entities the model missed.
+        """
+        self.entities = entities
+        self.label = nlp.vocab.strings.add(label)
+        self.matcher = PhraseMatcher(nlp.vocab, attr='LOWER')
+
+        names = sorted({name.replace('_', ' ').strip() for name in known_entities} - {''})
+        self.matcher.add('KNOWN_ENTITY', None, *nlp.tokenizer.pipe(names))
+
+    def __call__(self, doc):
+        """
+        Find every known entity in doc at once, then reset doc.ents a single time: our matches (longest wins when they
+        overlap) plus whichever of the model's entities they don't overlap.
+
+        :param doc: (spaCy doc) A parsed doc.
+        :return: (spaCy doc) The same doc, with known entities labeled.
+        """
+        # Only keep matches where the model missed at least part of the name.
+        spans = [Span(doc, start, end, label=self.label) for _, start, end in self.matcher(doc)]
+        spans = [span for span in spans if any(token.ent_type not in self.entities for token in span)]
+        if not spans:
+            return doc
+
+        spans = filter_spans(spans)
+        claimed = {i for span in spans for i in range(span.start, span.end)}
+        doc.ents = spans + [ent for ent in doc.ents if not claimed.intersection(range(ent.start, ent.end))]
+        return doc
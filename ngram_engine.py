@@ -0,0 +1,947 @@
+"""
+Counts ngrams over a TokenTable with NumPy instead of a Python loop per ngram. We find every ngram that passes our
+filters (no punctuation, no stop word on either end, at least one noun) for every length in one vectorized pass,
+count them as rows of integer token ids, and only build strings for the ngrams that survive min_text_id_count.
+
+Counts for different shards of texts merge exactly (see count_parallel), so a large corpus can be counted across
+several processes. The merged counts can be saved (CountSnapshot), so we can re-prune without counting again.
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import re
+
+import numpy as np
+
+from topic_records import NgramRecord, PostingLists, TextBitmap, TopicRecord
+
+
+def text_index(tokens):
+    """
+    :param tokens: (TokenTable) A finalized token table.
+    :return: (np.array of int64) One per token: the position of the text that the token belongs to.
+    """
+    return np.repeat(np.arange(len(tokens), dtype=np.int64), np.diff(tokens.offsets))
+
+
+def ngram_starts(context, lengths, first_row, end_row):
+    """
+    Find every ngram worth counting in token rows [first_row, end_row), for each length at once. An ngram must stay
+    inside one text, contain no punctuation, not begin or end with a stop word, and contain at least one noun (or
+    named entity).
+
+    :param context: (CountContext) The corpus-wide token arrays.
+    :param lengths: (iterable of int) The ngram lengths we want (e.g., 5, 4, 3, 2).
+    :param first_row: (int) The first token row of the shard; a text boundary.
+    :param end_row: (int) One past the last token row of the shard; also a text boundary.
+    :return: (dict) {ngram length: np.array of the token rows where each of those ngrams starts}
+    """
+    text_of = context.text_of
+    punct_total = context.punct_total
+    noun_total = context.noun_total
+
+    starts = {}
+    for n in lengths:
+        first = np.arange(first_row, max(end_row - n + 1, first_row), dtype=np.int64)
+        last = first + n - 1
+        keep = ((text_of[first] == text_of[last]) &
+                (punct_total[first + n] == punct_total[first]) &
+                ~context.stop[first] & ~context.stop[last] &
+                (noun_total[first + n] > noun_total[first]))
+        starts[n] = first[keep]
+    return starts
+
+
+def shard_bounds(tokens, shard_count):
+    """
+    Split the texts into shard_count contiguous runs with about the same number of tokens each.
+    :param tokens: (TokenTable) A finalized token table.
+    :param shard_count: (int) How many shards we want.
+    :return: (list) [(first text, one past the last text)], skipping empty shards.
+    """
+    targets = np.linspace(0, tokens.token_count, shard_count + 1)[1:-1]
+    cuts = [0] + np.searchsorted(tokens.offsets, targets).tolist() + [len(tokens)]
+    return [(start, end) for start, end in zip(cuts, cuts[1:]) if end > start]
+
+
+def _unique_rows(rows):
+    """
+    :param rows: (np.array, 2-d) One row per item.
+    :return: (np.array, np.array) The distinct rows (sorted), and for each input row, the index of its distinct row.
+    """
+    if not len(rows):
+        return rows, np.zeros(0, dtype=np.int64)
+    unique, inverse = np.unique(rows, axis=0, return_inverse=True)
+    return unique, inverse.reshape(-1)
+
+
+def _top_verbatims(rows, counts, k, keep=None):
+    """
+    Keep each key's k most common verbatims (a bounded top-k, so a topic with endless typos and casings stays small).
+    :param rows: (np.array, 2-d) Distinct rows of [key, verbatim string id x n], sorted.
+    :param counts: (np.array) How often each row occurs.
+    :param k: (int) How many verbatims to keep per key.
+    :param keep: (np.array of bool) Rows to keep whatever their rank.
+    :return: (np.array, np.array) The kept rows and their counts, sorted by key, then most common first (ties go to
+        the row that sorts first).
+    """
+    order = np.lexsort(tuple(rows[:, i] for i in range(rows.shape[1] - 1, 0, -1)) + (-counts, rows[:, 0]))
+    rows, counts = rows[order], counts[order]
+    key_start = np.searchsorted(rows[:, 0], rows[:, 0])  # each row's key starts here (rows are sorted by key)
+    top = np.arange(len(rows)) - key_start < k
+    if keep is not None:
+        top |= keep[order]
+    return rows[top], counts[top]
+
+
+def spellings(name, string_ids):
+    """
+    An ngram's name joins its tokens' norms with spaces, but a merged entity (e.g., 'simon peter') has a space of its
+    own, so a name can stand for more than one row of tokens; ngrams that read the same are counted together (see
+    NgramCounts._canonical_nodes). Split the name every way that we know each piece.
+    :param name: (str) An ngram name (lemmas joined by spaces).
+    :param string_ids: (dict) The token table's {string: id}.
+    :return: (list of tuple) Every row of string ids (2 or more) that reads as name.
+    """
+    words = name.split(' ')
+    rows = []
+    for cuts in itertools.product([False, True], repeat=len(words) - 1):
+        pieces, piece = [], [words[0]]
+        for cut, word in zip(cuts, words[1:]):
+            if cut:
+                pieces.append(' '.join(piece))
+                piece = [word]
+            else:
+                piece.append(word)
+        pieces.append(' '.join(piece))
+        if len(pieces) >= 2 and all(piece in string_ids for piece in pieces):
+            rows.append(tuple(string_ids[piece] for piece in pieces))
+    return rows
+
+
+def find_ngrams(norm, text_of, rows):
+    """
+    Find every occurrence of some ngrams (within a text) with one vectorized pass per length.
+    :param norm: (np.array of int) One string id per token (see TokenTable.norm).
+    :param text_of: (np.array of int) One per token: its text's position (see text_index).
+    :param rows: (list of tuple) The ngrams we're looking for, as rows of string ids (any lengths).
+    :return: (np.array, np.array) One entry per occurrence: the token row where it starts, and its position in rows.
+    """
+    found_starts, found_rows = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for n in sorted({len(row) for row in rows}):
+        index = np.array([i for i, row in enumerate(rows) if len(row) == n], dtype=np.int64)
+        wanted = np.array([rows[i] for i in index], dtype=np.int64)
+        first = np.arange(max(len(norm) - n + 1, 0))
+        first = first[text_of[first] == text_of[first + n - 1]]
+
+        # Match each window's hash against the wanted rows' hashes, then check the ids themselves.
+        wanted_hashes, window_hashes = _mix(np.full(len(wanted), n, dtype=np.uint64)), \
+            _mix(np.full(len(first), n, dtype=np.uint64))
+        for k in range(n):
+            wanted_hashes = _mix(wanted_hashes ^ wanted[:, k].astype(np.uint64))
+            window_hashes = _mix(window_hashes ^ norm[first + k].astype(np.uint64))
+        order = np.argsort(wanted_hashes)
+        match = np.minimum(np.searchsorted(wanted_hashes[order], window_hashes), len(order) - 1)
+        match = order[match]
+        hit = wanted_hashes[match] == window_hashes
+        first, match = first[hit], match[hit]
+        same = np.all(np.stack([norm[first + k] for k in range(n)], axis=1) == wanted[match], axis=1)
+        found_starts.append(first[same])
+        found_rows.append(index[match[same]])
+    return np.concatenate(found_starts), np.concatenate(found_rows)
+
+
+def demote_subsumed(ngrams, count_margin=3, text_id_margin=3):
+    """
+    Demote (set count to -1) each ngram that's contained in a one-word-longer ngram that's nearly as common: its
+    count + count_margin and text id count + text_id_margin both reach the shorter ngram's. Rather than testing every
+    pair of ngrams, we take each longer ngram, list the shorter ngrams it contains (usually just its first and last n
+    words), and look them up by name.
+
+    :param ngrams: (dict) Topic.ngrams: {ngram_lemma: NgramRecord}. Changed in place.
+    :param count_margin: (int) How far below the shorter ngram's count the longer ngram's count may be.
+    :param text_id_margin: (int) How far below the shorter ngram's text id count the longer ngram's may be.
+    :return: None
+    """
+    # {shorter ngram_lemma: [longer ngrams that contain it]}
+    containers = {}
+    for ngram_plus_lemma, ngram_plus in ngrams.items():
+        words = ngram_plus_lemma.split(' ')
+        # A token can hold a space (a merged entity like 'simon peter'), so an ngram of n - 1 tokens can span
+        # n - 1 or more of these words; without merged tokens that's just the first and last n - 1 words.
+        for length in range(ngram_plus.n - 1, len(words)):
+            for start in range(len(words) - length + 1):
+                ngram_lemma = ' '.join(words[start:start + length])
+                ngram = ngrams.get(ngram_lemma)
+                # (\b is a word boundary: 'man' is in 'son of man' but not in 'woman')
+                if ngram is not None and ngram.n + 1 == ngram_plus.n and \
+                        re.search(r'\b' + re.escape(ngram_lemma) + r'\b', ngram_plus_lemma):
+                    containers.setdefault(ngram_lemma, []).append(ngram_plus)
+
+    # Demote in ngram order; a longer ngram that was demoted first competes with its count of -1.
+    for ngram_lemma, ngram in ngrams.items():
+        for ngram_plus in containers.get(ngram_lemma, []):
+            if ngram_plus.count + count_margin >= ngram.count and \
+                    ngram_plus.text_id_count + text_id_margin >= ngram.text_id_count:
+                ngram.count = -1
+
+
+class CountContext(object):
+    """
+    The corpus-wide, per-token arrays that every shard reads while counting. We build it once (in the parent, or
+    once per worker process), so a shard only ever touches its own rows.
+    """
+
+    def __init__(self, tokens, stop, skip, nounish, max_n, window):
+        """
+        :param tokens: (TokenTable) A finalized token table.
+        :param stop: (np.array of bool) One per token: is the token's lemma a stop word?
+        :param skip: (np.array of bool) One per token: is the token a stop word or punctuation? (Never a topic.)
+        :param nounish: (np.array of bool) One per token: is the token a noun or named entity?
+        :param max_n: (int) The longest ngram length we count.
+        :param window: (int) How many tokens on either side of an ngram count as "near" it.
+        """
+        self.tokens = tokens
+        self.norm = tokens.norm
+        self.text_of = text_index(tokens)
+        self.stop = stop
+        self.nounish = nounish
+        self.max_n = max_n
+        self.window = window
+
+        # Running totals let us count the punctuation (or nouns) inside any window with a single subtraction.
+        self.punct_total = np.concatenate([[0], np.cumsum(tokens.punct, dtype=np.int64)])
+        self.noun_total = np.concatenate([[0], np.cumsum(nounish, dtype=np.int64)])
+
+        # Every token that counts toward a topic, and so every lemma that's a topic somewhere in the corpus
+        self.topic_rows = np.nonzero(nounish & ~skip)[0]
+        self.topic_positions = TopicPositions(tokens, set(np.unique(tokens.lemma[self.topic_rows]).tolist()))
+
+    def count(self, first_text, end_text):
+        """
+        Count topics and ngrams for one shard of texts.
+        :param first_text: (int) The position of the shard's first text.
+        :param end_text: (int) One past the position of the shard's last text.
+        :return: (TopicCounts, NgramCounts) The shard's counts; merge() them with the other shards' counts.
+        """
+        first_row, end_row = int(self.tokens.offsets[first_text]), int(self.tokens.offsets[end_text])
+        starts = ngram_starts(self, range(self.max_n, 1, -1), first_row, end_row)
+        return TopicCounts(self, first_row, end_row), NgramCounts(self, starts)
+
+
+# Each worker process builds its own CountContext once (see count_parallel), rather than receiving it with every shard.
+_worker_context = None
+
+
+def _start_worker(*args):
+    global _worker_context
+    _worker_context = CountContext(*args)
+
+
+def _count_shard(bounds):
+    return _worker_context.count(*bounds)
+
+
+def count_parallel(tokens, stop, skip, nounish, max_n, window, processes=1, shards_per_process=4):
+    """
+    Count topics and ngrams for the whole corpus, map-reduce style: split the texts into shards, count each shard in
+    a pool of worker processes, and merge the shard counts. Merging only sums counts, takes minimums (of first
+    appearance) and unions sets, so we get exactly the counts of a single pass, whatever the shard boundaries.
+
+    :param tokens, stop, skip, nounish, max_n, window: See CountContext.
+    :param processes: (int) Worker processes to use; 1 counts in this process (as a single shard), -1 uses every core.
+    :param shards_per_process: (int) How many shards each worker gets (on average), to even out uneven shards.
+    :return: (TopicCounts, NgramCounts) The counts for the whole corpus.
+    """
+    processes = multiprocessing.cpu_count() if processes == -1 else processes
+    shards = shard_bounds(tokens, processes * shards_per_process) if processes > 1 else [(0, len(tokens))]
+
+    if len(shards) <= 1:
+        context = CountContext(tokens, stop, skip, nounish, max_n, window)
+        parts = [context.count(start, end) for start, end in shards] or [context.count(0, 0)]
+    else:
+        with multiprocessing.Pool(min(processes, len(shards)), _start_worker,
+                                  (tokens, stop, skip, nounish, max_n, window)) as pool:
+            parts = pool.map(_count_shard, shards)
+
+    return TopicCounts.merge([part[0] for part in parts]), NgramCounts.merge([part[1] for part in parts])
+
+
+def chunk_bounds(tokens, chunk_texts):
+    """
+    :param tokens: (TokenTable) A finalized token table.
+    :param chunk_texts: (int) About how many texts we want in each chunk.
+    :return: (list) [(first text, one past the last text)]; at least one (maybe empty) chunk.
+    """
+    return shard_bounds(tokens, max(1, -(-len(tokens) // chunk_texts))) or [(0, 0)]
+
+
+def count_chunks(tokens, stop, skip, nounish, max_n, window, chunks, processes=1):
+    """
+    Count topics and ngrams one chunk of texts at a time, for callers that fold each chunk's counts into something
+    smaller (a sketch, a store on disk) before the next one comes in.
+
+    :param tokens, stop, skip, nounish, max_n, window: See CountContext.
+    :param chunks: (list) [(first text, one past the last text)], e.g., from chunk_bounds.
+    :param processes: (int) Worker processes that count chunks ahead of us; 1 counts in this process, -1 uses every
+        core.
+    :return: (generator) (TopicCounts, NgramCounts) for each chunk, in chunk order (whatever order they finish in).
+    """
+    processes = multiprocessing.cpu_count() if processes == -1 else processes
+    if processes > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(processes, len(chunks)), _start_worker,
+                                  (tokens, stop, skip, nounish, max_n, window)) as pool:
+            for part in pool.imap(_count_shard, chunks):
+                yield part
+    else:
+        context = CountContext(tokens, stop, skip, nounish, max_n, window)
+        for start, end in chunks:
+            yield context.count(start, end)
+
+
+def count_approximate(tokens, stop, skip, nounish, max_n, window, min_text_id_count, processes=1, chunk_texts=10000,
+                      sketch_width=2 ** 20, sketch_depth=4, promote_text_count=2, max_candidates=500000):
+    """
+    Count topics exactly, but ngrams approximately, in a fixed memory budget. Most distinct ngrams only ever occur in
+    one text, so instead of holding all of them we stream through the texts a chunk at a time: each chunk is counted
+    exactly, every one of its ngrams is added to a count-min sketch of text counts, and only the ngrams that the
+    sketch puts in at least promote_text_count texts (the candidates) are merged into an exactly tracked table. When
+    the table grows past max_candidates, the candidates in the fewest texts are evicted.
+
+    A sketch never underestimates, so a candidate misses fewer than promote_text_count of its texts (the ones before
+    it was promoted), unless it was evicted along the way. Either way, each ngram's tracked text count is a lower
+    bound and its sketch estimate an upper bound (per token row; see _canonical_nodes); the report sums them up.
+
+    :param tokens, stop, skip, nounish, max_n, window: See CountContext.
+    :param min_text_id_count: (int) The fewest texts an ngram will need (see Topic.select_topics_and_ngrams); only
+        used for the report.
+    :param processes: (int) Worker processes that count chunks (the sketch itself is updated here, in chunk order);
+        1 counts in this process, -1 uses every core.
+    :param chunk_texts: (int) About how many texts we count exactly at a time.
+    :param sketch_width, sketch_depth: (int) The sketch's counters per row (a power of 2) and its number of rows.
+    :param promote_text_count: (int) The sketch text count at which an ngram becomes a candidate.
+    :param max_candidates: (int) The most ngrams we track exactly.
+    :return: (TopicCounts, NgramCounts, dict) The counts (with ngrams for the candidates only) and a JSON-ready
+        report of the approximation and its error bounds.
+    """
+    chunks = chunk_bounds(tokens, chunk_texts)
+    sketch = CountMinSketch(sketch_width, sketch_depth)
+    topic_counts, tracked = None, None
+    evicted, max_evicted_text_count = 0, 0
+
+    for topic_part, ngram_part in count_chunks(tokens, stop, skip, nounish, max_n, window, chunks, processes):
+        topic_counts = topic_part if topic_counts is None else TopicCounts.merge([topic_counts, topic_part])
+
+        # Sketch the chunk's text counts, then keep its ngrams that are (or just became) candidates.
+        hashes = ngram_part.hashes()
+        sketch.add(hashes, ngram_part.text_id_counts())
+        promote = sketch.estimate(hashes) >= promote_text_count
+        if tracked is not None:
+            promote |= np.isin(hashes, tracked.hashes())
+        tracked = ngram_part.subset(promote) if tracked is None else \
+            NgramCounts.merge([tracked, ngram_part.subset(promote)])
+
+        if len(tracked.node_n) > max_candidates:
+            # Keep the candidates in the most texts (ties go to the ones we saw first).
+            text_id_counts = tracked.text_id_counts()
+            order = np.lexsort((tracked.node_first, -text_id_counts))
+            keep = np.zeros(len(order), dtype=bool)
+            keep[order[:max_candidates]] = True
+            evicted += int((~keep).sum())
+            max_evicted_text_count = max(max_evicted_text_count, int(text_id_counts[~keep].max()))
+            tracked = tracked.subset(keep)
+
+    # Tracked text counts are lower bounds and sketch estimates upper bounds; ngrams with min_text_id_count between
+    # the two might be kept or dropped wrongly.
+    # (An evicted ngram can be promoted and evicted again, so then only the sketch bounds what it missed.)
+    lower, upper = tracked.text_id_counts(), sketch.estimate(tracked.hashes())
+    kept = lower >= min_text_id_count
+    max_gap = int((upper - lower)[kept].max()) if kept.any() else 0
+    report = {'chunks': len(chunks), 'sketchWidth': sketch_width, 'sketchDepth': sketch_depth,
+              'promoteTextCount': promote_text_count, 'maxCandidates': max_candidates,
+              'candidates': len(tracked.node_n), 'evicted': evicted, 'maxEvictedTextCount': max_evicted_text_count,
+              'sketchTotal': sketch.total,
+              'sketchOvercount': sketch.overcount(), 'sketchConfidence': round(sketch.confidence(), 4),
+              'maxMissedTexts': max_gap if evicted else promote_text_count - 1, 'maxTextCountGap': max_gap,
+              'uncertainNgrams': int(((lower < min_text_id_count) & (upper >= min_text_id_count)).sum())}
+    return topic_counts, tracked, report
+
+
+class CountMinSketch(object):
+    """
+    A count-min sketch: depth rows of width counters, each row with its own hash of the key. Adding a key adds to one
+    counter per row; its estimate is the smallest of those counters. Collisions only ever add, so an estimate is never
+    low, and with probability confidence() it's high by at most overcount(). Memory is fixed: width x depth counters.
+    """
+
+    def __init__(self, width, depth):
+        """
+        :param width: (int) Counters per row; a power of 2.
+        :param depth: (int) The number of rows (hash functions).
+        """
+        assert width > 0 and width & (width - 1) == 0, 'The sketch width must be a power of 2.'
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.uint32)
+        self.total = 0  # the sum of everything we've added
+        self._seeds = np.array([_mix(np.array([row + 1], dtype=np.uint64))[0] for row in range(depth)],
+                               dtype=np.uint64)
+
+    def _columns(self, hashes, row):
+        return (_mix(hashes ^ self._seeds[row]) & np.uint64(self.width - 1)).astype(np.int64)
+
+    def add(self, hashes, counts):
+        """
+        :param hashes: (np.array of uint64) Key hashes (see NgramCounts.hashes).
+        :param counts: (np.array of int) How much to add for each key.
+        :return: None
+        """
+        counts = np.asarray(counts, dtype=np.uint32)
+        for row in range(self.depth):
+            np.add.at(self.table[row], self._columns(hashes, row), counts)
+        self.total += int(counts.sum())
+
+    def estimate(self, hashes):
+        """
+        :param hashes: (np.array of uint64) Key hashes.
+        :return: (np.array of int64) An upper bound on each key's total.
+        """
+        estimate = np.full(len(hashes), np.iinfo(np.int64).max, dtype=np.int64)
+        for row in range(self.depth):
+            estimate = np.minimum(estimate, self.table[row][self._columns(hashes, row)])
+        return estimate
+
+    def overcount(self):
+        """
+        :return: (int) How high an estimate can be (with probability confidence()): e / width of the total.
+        """
+        return int(np.ceil(np.e / self.width * self.total))
+
+    def confidence(self):
+        """
+        :return: (float) The chance that a given estimate is within overcount() of the truth: 1 - e^-depth.
+        """
+        return 1 - np.exp(-self.depth)
+
+
+def _mix(values):
+    """
+    Scramble 64-bit integers (the finalizer of MurmurHash3), so that nearby inputs land far apart.
+    :param values: (np.array of uint64)
+    :return: (np.array of uint64)
+    """
+    with np.errstate(over='ignore'):
+        values = values ^ (values >> np.uint64(33))
+        values = values * np.uint64(0xff51afd7ed558ccd)
+        values = values ^ (values >> np.uint64(33))
+        values = values * np.uint64(0xc4ceb3fe1a85ec53)
+        return values ^ (values >> np.uint64(33))
+
+
+class TopicCounts(object):
+    """
+    Raw (unpruned) single-word topic counts, keyed by lemma id: how often each topic occurs, where it first occurs,
+    the distinct (topic, text) pairs, and how often each (topic, verbatim) pair occurs.
+    """
+
+    def __init__(self, context, first_row, end_row):
+        """
+        :param context: (CountContext) The corpus-wide token arrays.
+        :param first_row: (int) The shard's first token row.
+        :param end_row: (int) One past the shard's last token row.
+        """
+        tokens = context.tokens
+        rows = context.topic_rows[np.searchsorted(context.topic_rows, first_row):
+                                  np.searchsorted(context.topic_rows, end_row)]
+        lemma = tokens.lemma[rows].astype(np.int64)
+
+        self.lemmas, inverse = np.unique(lemma, return_inverse=True)
+        self.count = np.bincount(inverse, minlength=len(self.lemmas))
+        self.first = np.full(len(self.lemmas), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(self.first, inverse, rows)
+        self.text_pairs = _unique_rows(np.column_stack([lemma, context.text_of[rows]]))[0]  # rows of [lemma, text]
+        self.verbatim_pairs, inverse = _unique_rows(np.column_stack([lemma, tokens.lower[rows]]))  # [lemma, lower]
+        self.verbatim_counts = np.bincount(inverse, minlength=len(self.verbatim_pairs))
+
+    @classmethod
+    def merge(cls, parts):
+        """
+        :param parts: (list of TopicCounts) Counts for different shards of texts.
+        :return: (TopicCounts) The counts for all of those texts together.
+        """
+        merged = cls.__new__(cls)
+        merged.lemmas, inverse = np.unique(np.concatenate([part.lemmas for part in parts]), return_inverse=True)
+        merged.count = np.bincount(inverse, weights=np.concatenate([part.count for part in parts]),
+                                   minlength=len(merged.lemmas)).astype(np.int64)
+        merged.first = np.full(len(merged.lemmas), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(merged.first, inverse, np.concatenate([part.first for part in parts]))
+        merged.text_pairs = _unique_rows(np.concatenate([part.text_pairs for part in parts]))[0]
+        merged.verbatim_pairs, inverse = _unique_rows(np.concatenate([part.verbatim_pairs for part in parts]))
+        merged.verbatim_counts = np.bincount(inverse, weights=np.concatenate([part.verbatim_counts for part in parts]),
+                                             minlength=len(merged.verbatim_pairs)).astype(np.int64)
+        return merged
+
+    @property
+    def nbytes(self):
+        """
+        :return: (int) The memory our arrays take up.
+        """
+        return sum(array.nbytes for array in (self.lemmas, self.count, self.first, self.text_pairs, self.verbatim_pairs,
+                                              self.verbatim_counts))
+
+    def materialize(self, strings, max_verbatims=10):
+        """
+        :param strings: (list of str) The token table's strings.
+        :param max_verbatims: (int) How many of each topic's verbatims to keep (the most common ones).
+        :return: (dict) Topic.topics: {topic: TopicRecord}, in the order that we first saw each topic.
+        """
+        # Both pair arrays are sorted by lemma, so each topic's texts (and verbatims) are one slice.
+        text_bounds = np.append(np.searchsorted(self.text_pairs[:, 0], self.lemmas), len(self.text_pairs)).tolist()
+        text_bitmaps = TextBitmap.from_groups(self.text_pairs[:, 1], text_bounds)
+        verbatims, verbatim_counts = _top_verbatims(self.verbatim_pairs, self.verbatim_counts, max_verbatims)
+        verbatim_bounds = np.append(np.searchsorted(verbatims[:, 0], self.lemmas), len(verbatims)).tolist()
+        lowers, verbatim_counts = verbatims[:, 1].tolist(), verbatim_counts.tolist()
+
+        topics = {}
+        for i in np.argsort(self.first, kind='stable').tolist():
+            topic = strings[self.lemmas[i]]
+            start, end = verbatim_bounds[i], verbatim_bounds[i + 1]
+            topics[topic] = TopicRecord(topic, int(self.count[i]), text_bitmaps[i],
+                                        tuple(strings[lower] for lower in lowers[start:end]),
+                                        tuple(verbatim_counts[start:end]))
+        return topics
+
+
+class TopicPositions(object):
+    """
+    A position index of every token whose lemma is a topic we're tracking. It answers "which topics occur within k
+    tokens of span [a, b)?" with a binary search instead of a scan over each ngram's window. Token rows are grouped by
+    text, so each text's topic positions are one contiguous, sorted slice of self.rows.
+    """
+
+    def __init__(self, tokens, topic_lemmas):
+        """
+        :param tokens: (TokenTable) A finalized token table.
+        :param topic_lemmas: (set of int) Lemma ids of the topics we're tracking.
+        """
+        self.offsets = tokens.offsets
+        self.rows = np.nonzero(np.isin(tokens.lemma, np.array(sorted(topic_lemmas), dtype=np.int32)))[0]
+        self.lemmas = tokens.lemma[self.rows]
+
+    def near(self, starts, ends, window, texts):
+        """
+        Find the topics near many spans at once. A span's neighborhood runs from window tokens before its start to
+        window tokens past its end, clipped to its own text.
+
+        :param starts: (np.array of int) The first token row of each span.
+        :param ends: (np.array of int) One past the last token row of each span.
+        :param window: (int) How many tokens on either side count as near.
+        :param texts: (np.array of int) The text that each span is in.
+        :return: (np.array, np.array) One entry per (span, nearby topic occurrence): the span's position in starts,
+            and the topic's lemma id.
+        """
+        low = np.searchsorted(self.rows, np.maximum(self.offsets[texts], starts - window))
+        high = np.searchsorted(self.rows, np.minimum(self.offsets[texts + 1], ends + window))
+        found = high - low
+
+        # Expand each span's [low, high) slice of self.rows into one entry per topic occurrence.
+        span = np.repeat(np.arange(len(starts)), found)
+        step = np.arange(found.sum()) - np.repeat(np.cumsum(found) - found, found)
+        return span, self.lemmas[np.repeat(low, found) + step]
+
+
+class NgramCounts(object):
+    """
+    Raw (unpruned) ngram counts, with each distinct ngram held as a row of token ids. Every distinct ngram of every
+    length gets a node id; most arrays below are indexed by node.
+    """
+
+    def __init__(self, context, starts):
+        """
+        Count every ngram found by ngram_starts, and note which tracked topics occur near each one.
+
+        :param context: (CountContext) The corpus-wide token arrays.
+        :param starts: (dict) See ngram_starts().
+        """
+        tokens = context.tokens
+        norm = context.norm
+        text_of = context.text_of
+        max_n = context.max_n
+        total = tokens.token_count
+
+        self.text_count = len(tokens)
+        self.rows = {}  # {n: (np.array, node count x n) of norm ids}
+        self.node_offset = {}  # {n: the node id of that length's first row}
+        node_n, node_count, node_first, text_pairs, subtopics = [], [], [], [], []
+        verbatim_rows, verbatim_counts = {}, {}
+        node_total = 0
+
+        for n in sorted(starts, reverse=True):
+            first = starts[n]
+            rows = np.stack([norm[first + k] for k in range(n)], axis=1) if len(first) else \
+                np.zeros((0, n), dtype=np.int32)
+            unique, inverse = _unique_rows(rows)
+            node = inverse + node_total
+            texts = text_of[first]
+
+            self.rows[n] = unique
+            self.node_offset[n] = node_total
+            node_n.append(np.full(len(unique), n, dtype=np.int64))
+            node_count.append(np.bincount(inverse, minlength=len(unique)))
+
+            # The order that we first see each ngram: by text, then longest ngrams first, then position.
+            seen = (texts * max_n + (max_n - n)) * (total + 1) + first
+            earliest = np.full(len(unique), np.iinfo(np.int64).max, dtype=np.int64)
+            np.minimum.at(earliest, inverse, seen)
+            node_first.append(earliest)
+
+            text_pairs.append(np.unique(node * self.text_count + texts))
+            lower_rows = np.stack([tokens.lower[first + k] for k in range(n)], axis=1) if len(first) else \
+                np.zeros((0, n), dtype=np.int32)
+            verbatim_rows[n], inverse = _unique_rows(np.column_stack([node, lower_rows]).astype(np.int64))
+            verbatim_counts[n] = np.bincount(inverse, minlength=len(verbatim_rows[n]))
+
+            # Every (topic, ngram, text) where the topic occurs within window tokens of the ngram
+            occurrence, topic_lemma = context.topic_positions.near(first, first + n, context.window, texts)
+            subtopics.append(np.column_stack([topic_lemma, node[occurrence], texts[occurrence]]).astype(np.int64))
+            node_total += len(unique)
+
+        self.node_n = np.concatenate(node_n) if node_n else np.zeros(0, dtype=np.int64)
+        self.node_count = np.concatenate(node_count) if node_count else np.zeros(0, dtype=np.int64)
+        self.node_first = np.concatenate(node_first) if node_first else np.zeros(0, dtype=np.int64)
+        self.text_pairs = np.concatenate(text_pairs) if text_pairs else np.zeros(0, dtype=np.int64)
+        self.verbatim_rows = verbatim_rows  # {n: (np.array) distinct rows of [node, lower id x n]}
+        self.verbatim_counts = verbatim_counts  # {n: (np.array) how often each of those rows occurs}
+        self.subtopics = _unique_rows(np.concatenate(subtopics))[0] if subtopics else np.zeros((0, 3), np.int64)
+        self._merged = None  # see _merged_counts
+
+    @classmethod
+    def merge(cls, parts):
+        """
+        Combine the counts of different shards of texts. Each length's distinct rows are re-numbered together (sorted,
+        as a single pass would number them), then each shard's per-node arrays are carried over to the new node ids.
+
+        :param parts: (list of NgramCounts) Counts for different shards of texts (all counting the same lengths).
+        :return: (NgramCounts) The counts for all of those texts together.
+        """
+        if len(parts) == 1:
+            return parts[0]
+
+        merged = cls.__new__(cls)
+        merged.text_count = parts[0].text_count
+        merged.rows, merged.node_offset, merged.verbatim_rows, merged.verbatim_counts = {}, {}, {}, {}
+        remaps = [np.zeros(len(part.node_n), dtype=np.int64) for part in parts]  # {part: old node -> new node}
+        node_total = 0
+
+        for n in sorted(parts[0].rows, reverse=True):
+            unique, inverse = _unique_rows(np.concatenate([part.rows[n] for part in parts]))
+            merged.rows[n] = unique
+            merged.node_offset[n] = node_total
+            position = 0
+            for part, remap in zip(parts, remaps):
+                size = len(part.rows[n])
+                remap[part.node_offset[n]:part.node_offset[n] + size] = inverse[position:position + size] + node_total
+                position += size
+            node_total += len(unique)
+
+        node = np.concatenate(remaps)
+        merged.node_n = np.zeros(node_total, dtype=np.int64)
+        merged.node_n[node] = np.concatenate([part.node_n for part in parts])
+        merged.node_count = np.bincount(node, weights=np.concatenate([part.node_count for part in parts]),
+                                        minlength=node_total).astype(np.int64)
+        merged.node_first = np.full(node_total, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(merged.node_first, node, np.concatenate([part.node_first for part in parts]))
+
+        text_count = merged.text_count
+        merged.text_pairs = np.unique(np.concatenate(
+            [remap[part.text_pairs // text_count] * text_count + part.text_pairs % text_count
+             for part, remap in zip(parts, remaps)]))
+        for n in merged.rows:
+            verbatim_rows = [part.verbatim_rows[n].copy() for part in parts]
+            for rows, remap in zip(verbatim_rows, remaps):
+                rows[:, 0] = remap[rows[:, 0]]
+            merged.verbatim_rows[n], inverse = _unique_rows(np.concatenate(verbatim_rows))
+            merged.verbatim_counts[n] = np.bincount(
+                inverse, weights=np.concatenate([part.verbatim_counts[n] for part in parts]),
+                minlength=len(merged.verbatim_rows[n])).astype(np.int64)
+        subtopics = [part.subtopics.copy() for part in parts]
+        for rows, remap in zip(subtopics, remaps):
+            rows[:, 1] = remap[rows[:, 1]]
+        merged.subtopics = _unique_rows(np.concatenate(subtopics))[0]
+        merged._merged = None
+        return merged
+
+    @property
+    def nbytes(self):
+        """
+        :return: (int) The memory our arrays take up.
+        """
+        arrays = [self.node_n, self.node_count, self.node_first, self.text_pairs, self.subtopics]
+        arrays += list(self.rows.values()) + list(self.verbatim_rows.values()) + list(self.verbatim_counts.values())
+        return sum(array.nbytes for array in arrays)
+
+    def hashes(self):
+        """
+        :return: (np.array of uint64) One per node: a hash of the ngram's length and norm ids (the same ngram gets the
+            same hash in every shard).
+        """
+        hashes = [np.zeros(0, dtype=np.uint64)]
+        for n in sorted(self.rows, reverse=True):
+            rows = self.rows[n].astype(np.uint64)
+            hashed = _mix(np.full(len(rows), n, dtype=np.uint64))
+            for k in range(n):
+                hashed = _mix(hashed ^ rows[:, k])
+            hashes.append(hashed)
+        return np.concatenate(hashes)
+
+    def text_id_counts(self):
+        """
+        :return: (np.array of int64) One per node: how many texts the ngram occurs in (counting rows that spell the
+            same ngram separately; see _canonical_nodes).
+        """
+        return np.bincount(self.text_pairs // self.text_count, minlength=len(self.node_n)).astype(np.int64)
+
+    def subset(self, keep):
+        """
+        :param keep: (np.array of bool) One per node: do we keep it?
+        :return: (NgramCounts) The counts for the kept nodes only, re-numbered (in the same order).
+        """
+        subset = NgramCounts.__new__(NgramCounts)
+        subset.text_count = self.text_count
+        subset.rows, subset.node_offset, subset.verbatim_rows, subset.verbatim_counts = {}, {}, {}, {}
+        node_id = np.cumsum(keep) - 1  # {old node: new node}, for kept nodes
+        node_total = 0
+        for n in sorted(self.rows, reverse=True):
+            subset.rows[n] = self.rows[n][keep[self.node_offset[n]:self.node_offset[n] + len(self.rows[n])]]
+            subset.node_offset[n] = node_total
+            node_total += len(subset.rows[n])
+
+            kept_rows = keep[self.verbatim_rows[n][:, 0]]
+            subset.verbatim_rows[n] = self.verbatim_rows[n][kept_rows]
+            subset.verbatim_rows[n][:, 0] = node_id[subset.verbatim_rows[n][:, 0]]
+            subset.verbatim_counts[n] = self.verbatim_counts[n][kept_rows]
+
+        subset.node_n, subset.node_count, subset.node_first = self.node_n[keep], self.node_count[keep], \
+            self.node_first[keep]
+        pair_node = self.text_pairs // self.text_count
+        kept_pairs = keep[pair_node]
+        subset.text_pairs = node_id[pair_node[kept_pairs]] * self.text_count + \
+            self.text_pairs[kept_pairs] % self.text_count
+        subset.subtopics = self.subtopics[keep[self.subtopics[:, 1]]]
+        subset.subtopics[:, 1] = node_id[subset.subtopics[:, 1]]
+        subset._merged = None
+        return subset
+
+    def _row(self, node):
+        """
+        :param node: (int) A node id.
+        :return: (np.array) That ngram's norm ids.
+        """
+        n = int(self.node_n[node])
+        return self.rows[n][node - self.node_offset[n]]
+
+    def _canonical_nodes(self, strings, string_ids):
+        """
+        Two different token rows can spell the same ngram: a merged entity like 'simon peter' + 'say' reads the same as
+        'simon' + 'peter' + 'say'. Ngrams are keyed by their string, so those rows have to be counted together. Only
+        rows with a space inside one of their tokens can collide, so we only build strings for those.
+
+        :return: (np.array) For each node, the node that it's counted under (the group member we saw first).
+        """
+        canonical = np.arange(len(self.node_n))
+        space_ids = np.array([i for i, string in enumerate(strings) if ' ' in string], dtype=np.int32)
+        if not len(space_ids):
+            return canonical
+
+        groups = {}  # {ngram string: [nodes]}
+        for n, rows in self.rows.items():
+            for u in np.nonzero(np.isin(rows, space_ids).any(axis=1))[0]:
+                name = ' '.join([strings[i] for i in rows[u]])
+                groups.setdefault(name, []).append(self.node_offset[n] + int(u))
+
+        # Look for rows without spaces that spell the same thing (e.g., 'simon', 'peter', 'say').
+        lookups = {}  # {n: {row tuple: node}}, built only for the lengths we need
+        for name, nodes in groups.items():
+            words = name.split(' ')
+            if len(words) not in self.rows or not all(word in string_ids for word in words):
+                continue
+            if len(words) not in lookups:
+                lookups[len(words)] = {tuple(row): self.node_offset[len(words)] + u for
+                                       u, row in enumerate(self.rows[len(words)].tolist())}
+            node = lookups[len(words)].get(tuple(string_ids[word] for word in words))
+            if node is not None and node not in nodes:
+                nodes.append(node)
+
+        for nodes in groups.values():
+            if len(nodes) > 1:
+                canonical[nodes] = min(nodes, key=lambda node: self.node_first[node])
+        return canonical
+
+    def _merged_counts(self, strings, string_ids):
+        """
+        The part of materialize that doesn't depend on its settings: counts, (node, text) pairs and subtopics with
+        every node folded into its canonical node. We work it out once and keep it, so re-selecting with other
+        settings (see Topic.reprune) skips it.
+        :return: (tuple) canonical (see _canonical_nodes), count and text_id_count (by node), pairs (node * text_count
+            + text, sorted) and subtopics (rows of [topic lemma, node, text], sorted).
+        """
+        if self._merged is None:
+            canonical = self._canonical_nodes(strings, string_ids)
+            count = np.bincount(canonical, weights=self.node_count, minlength=len(canonical)).astype(np.int64)
+            pair_node = canonical[self.text_pairs // self.text_count]
+            pairs = np.unique(pair_node * self.text_count + self.text_pairs % self.text_count)
+            text_id_count = np.bincount(pairs // self.text_count, minlength=len(canonical))
+            subtopics = _unique_rows(np.column_stack([self.subtopics[:, 0], canonical[self.subtopics[:, 1]],
+                                                      self.subtopics[:, 2]]))[0]
+            self._merged = canonical, count, pairs, text_id_count, subtopics
+        return self._merged
+
+    def materialize(self, strings, string_ids, min_text_id_count, topics, max_verbatims=10):
+        """
+        Turn our integer counts into self.ngrams records (and topic subtopics), but only for the ngrams that occur in
+        at least min_text_id_count texts.
+
+        :param strings: (list of str) The token table's strings.
+        :param string_ids: (dict) The token table's {string: id}.
+        :param min_text_id_count: (int) The fewest texts an ngram must occur in to be kept.
+        :param topics: (dict) Topic.topics; each topic gets the kept ngrams near it as its subtopics.
+        :param max_verbatims: (int) How many of each ngram's verbatims to keep (the most common ones).
+        :return: (dict) {ngram_lemma: NgramRecord}, in the order that we first saw each ngram.
+        """
+        canonical, count, pairs, text_id_count, subtopics = self._merged_counts(strings, string_ids)
+        node_total = len(canonical)
+
+        keep = np.zeros(node_total, dtype=bool)
+        keep[text_id_count >= min_text_id_count] = True
+        keep &= canonical == np.arange(node_total)
+
+        # Kept ngrams get ids in the order that we first saw them.
+        by_node = np.nonzero(keep)[0]
+        kept = by_node[np.argsort(self.node_first[by_node], kind='stable')]
+        ngram_id = np.full(node_total, -1, dtype=np.int64)
+        ngram_id[kept] = np.arange(len(kept))
+
+        # Pairs are sorted by node, then text, so each ngram's texts are one slice (in by_node order).
+        pairs = pairs[keep[pairs // self.text_count]]
+        pair_node, pair_text = pairs // self.text_count, pairs % self.text_count
+        text_bitmaps = TextBitmap.from_groups(pair_text, np.append(np.searchsorted(pair_node, by_node),
+                                                                  len(pair_node)))
+        text_bitmaps = [text_bitmaps[i] for i in np.searchsorted(by_node, kept).tolist()]
+
+        # Verbatim strings for each kept ngram's most common verbatims. Nodes counted together (see _canonical_nodes)
+        # keep all of their rows until we've added up the counts of matching strings.
+        grouped = (canonical != np.arange(node_total)) | (np.bincount(canonical, minlength=node_total) > 1)
+        verbatims = {}  # {node: {verbatim: count}}
+        for n, rows in self.verbatim_rows.items():
+            kept_rows = keep[canonical[rows[:, 0]]]
+            rows, counts = _top_verbatims(rows[kept_rows], self.verbatim_counts[n][kept_rows], max_verbatims,
+                                          grouped[rows[kept_rows][:, 0]])
+            for row, row_count in zip(rows.tolist(), counts.tolist()):
+                node_verbatims = verbatims.setdefault(canonical[row[0]], {})
+                verbatim = ' '.join([strings[i] for i in row[1:]])
+                node_verbatims[verbatim] = node_verbatims.get(verbatim, 0) + row_count
+
+        # Strings for kept ngrams only: names and verbatims
+        ngrams = {}
+        for i, node in enumerate(kept.tolist()):
+            name = ' '.join([strings[string_id] for string_id in self._row(node)])
+            top = sorted(verbatims.get(node, {}).items(), key=lambda item: item[1], reverse=True)[:max_verbatims]
+            ngrams[name] = NgramRecord(i, name, int(count[node]), int(self.node_n[node]), text_bitmaps[i],
+                                       tuple(verbatim for verbatim, _ in top), tuple(count for _, count in top))
+
+        # Rows of [topic lemma, ngram id, text], sorted, so each topic's subtopics are one slice.
+        subtopics = subtopics[keep[subtopics[:, 1]]]
+        subtopics = np.column_stack([subtopics[:, 0], ngram_id[subtopics[:, 1]], subtopics[:, 2]])
+        subtopics = subtopics[np.lexsort((subtopics[:, 2], subtopics[:, 1], subtopics[:, 0]))]
+        topic_lemmas, starts = np.unique(subtopics[:, 0], return_index=True)
+        ends = np.append(starts[1:], len(subtopics))
+        for topic_lemma, start, end in zip(topic_lemmas.tolist(), starts.tolist(), ends.tolist()):
+            topic = topics.get(strings[topic_lemma])
+            if topic is not None:
+                topic.subtopics = PostingLists.from_pairs(subtopics[start:end, 1], subtopics[start:end, 2])
+
+        return ngrams
+
+
+class CountSnapshot(object):
+    """
+    Everything we need to re-select and re-prune topics without re-reading (or re-tokenizing) the texts: the raw,
+    unpruned topic and ngram counts, the strings that their ids point to, and each text's textId. It's saved as a
+    single compressed NumPy (.npz) file of integer arrays.
+    """
+
+    def __init__(self, topic_counts, ngram_counts, strings, text_ids, meta):
+        """
+        :param topic_counts: (TopicCounts) The merged topic counts.
+        :param ngram_counts: (NgramCounts) The merged ngram counts.
+        :param strings: (list of str) The token table's strings.
+        :param text_ids: (list) Each text's textId, by position.
+        :param meta: (dict) JSON-ready details about the run (corpus name, data date, text count, counting settings).
+        """
+        self.topic_counts = topic_counts
+        self.ngram_counts = ngram_counts
+        self.strings = strings
+        self.string_ids = {string: i for i, string in enumerate(strings)}
+        self.text_ids = text_ids
+        self.meta = meta
+
+    def save(self, file_name):
+        """
+        :param file_name: (str) Where to save the snapshot (we add .npz if it's missing).
+        :return: None
+        """
+        topics, ngrams = self.topic_counts, self.ngram_counts
+        lengths = sorted(ngrams.rows, reverse=True)
+        arrays = {'topic_lemmas': topics.lemmas, 'topic_count': topics.count, 'topic_first': topics.first,
+                  'topic_text_pairs': topics.text_pairs, 'topic_verbatim_pairs': topics.verbatim_pairs,
+                  'topic_verbatim_counts': topics.verbatim_counts,
+                  'node_n': ngrams.node_n, 'node_count': ngrams.node_count, 'node_first': ngrams.node_first,
+                  'text_pairs': ngrams.text_pairs, 'subtopics': ngrams.subtopics,
+                  'lengths': np.array(lengths, dtype=np.int64),
+                  'node_offset': np.array([ngrams.node_offset[n] for n in lengths], dtype=np.int64)}
+        for n in lengths:
+            arrays['rows_{}'.format(n)] = ngrams.rows[n]
+            arrays['verbatim_rows_{}'.format(n)] = ngrams.verbatim_rows[n]
+            arrays['verbatim_counts_{}'.format(n)] = ngrams.verbatim_counts[n]
+
+        # Strings, textIds and meta go in as UTF-8 JSON bytes, so loading never needs pickle.
+        for key, value in [('strings', self.strings), ('text_ids', self.text_ids),
+                           ('meta', dict(self.meta, text_count=ngrams.text_count))]:
+            arrays[key] = np.frombuffer(json.dumps(value).encode('utf-8'), dtype=np.uint8)
+
+        folder = os.path.dirname(file_name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        np.savez_compressed(file_name, **arrays)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        :param file_name: (str) A file written by save().
+        :return: (CountSnapshot)
+        """
+        with np.load(file_name) as arrays:
+            strings, text_ids, meta = [json.loads(arrays[key].tobytes().decode('utf-8'))
+                                       for key in ('strings', 'text_ids', 'meta')]
+
+            topics = TopicCounts.__new__(TopicCounts)
+            topics.lemmas, topics.count, topics.first = arrays['topic_lemmas'], arrays['topic_count'], \
+                arrays['topic_first']
+            topics.text_pairs, topics.verbatim_pairs = arrays['topic_text_pairs'], arrays['topic_verbatim_pairs']
+            topics.verbatim_counts = arrays['topic_verbatim_counts']
+
+            ngrams = NgramCounts.__new__(NgramCounts)
+            ngrams.text_count = meta['text_count']
+            ngrams.node_n, ngrams.node_count, ngrams.node_first = arrays['node_n'], arrays['node_count'], \
+                arrays['node_first']
+            ngrams.text_pairs, ngrams.subtopics = arrays['text_pairs'], arrays['subtopics']
+            lengths = arrays['lengths'].tolist()
+            ngrams.node_offset = dict(zip(lengths, arrays['node_offset'].tolist()))
+            ngrams.rows = {n: arrays['rows_{}'.format(n)] for n in lengths}
+            ngrams.verbatim_rows = {n: arrays['verbatim_rows_{}'.format(n)] for n in lengths}
+            ngrams.verbatim_counts = {n: arrays['verbatim_counts_{}'.format(n)] for n in lengths}
+            ngrams._merged = None
+
+        return cls(topics, ngrams, strings, text_ids, meta)
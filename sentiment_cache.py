@@ -0,0 +1,88 @@
+"""
+A persistent cache of VADER sentiment scores. A text's scores never change unless the analyzer does, yet daily re-runs
+score mostly the same texts again. Scores are keyed by a hash of the text plus the analyzer's version (the
+vaderSentiment release and hashes of its lexicon files), so upgrading VADER or editing a lexicon starts fresh.
+
+Scores live in a small SQLite file, so we can look up a whole corpus's worth of keys in a few bulk queries.
+"""
+
+import hashlib
+import importlib.metadata
+import os
+import sqlite3
+
+from doc_cache import file_hash
+
+
+def analyzer_version(analyzer):
+    """
+    :param analyzer: (SentimentIntensityAnalyzer) A VADER analyzer.
+    :return: (str) Everything besides the text that changes its scores: the package version and lexicon hashes.
+    """
+    try:
+        version = importlib.metadata.version('vaderSentiment')
+    except importlib.metadata.PackageNotFoundError:
+        version = ''
+    return '|'.join([version, file_hash(analyzer.lexicon_full_filepath), file_hash(analyzer.emoji_full_filepath)])
+
+
+class SentimentCache(object):
+    """
+    Save and load sentiment scores (compound, pos, neg, neu), keyed by text hash + analyzer version.
+    """
+
+    def __init__(self, version, file_name):
+        """
+        :param version: (str) The analyzer version (see analyzer_version); it's folded into every key.
+        :param file_name: (str) The cache file (created if it doesn't exist).
+        """
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+        folder = os.path.dirname(file_name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.db = sqlite3.connect(file_name)
+        self.db.execute('CREATE TABLE IF NOT EXISTS score (key TEXT PRIMARY KEY, compound REAL, pos REAL, neg REAL, '
+                        'neu REAL) WITHOUT ROWID')
+
+    def key(self, raw_text):
+        """
+        :param raw_text: (str) The exact text we'd hand to the analyzer.
+        :return: (str) The cache key for this text under our analyzer version.
+        """
+        return hashlib.sha1((self.version + '\n' + raw_text).encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """
+        Look up many keys at once. Counts toward our hits and misses.
+        :param keys: (list of str) Cache keys (see key()).
+        :return: (dict) {key: (compound, pos, neg, neu)} for the keys we have.
+        """
+        found = {}
+        unique = list(set(keys))
+        for i in range(0, len(unique), 500):  # SQLite limits how many parameters a query can take
+            batch = unique[i:i + 500]
+            for key, *scores in self.db.execute('SELECT key, compound, pos, neg, neu FROM score WHERE key IN ({})'
+                                                .format(','.join('?' * len(batch))), batch):
+                found[key] = tuple(scores)
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, scores):
+        """
+        Save newly computed scores, in a single transaction.
+        :param scores: (dict) {key: (compound, pos, neg, neu)}
+        :return: None
+        """
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO score VALUES (?, ?, ?, ?, ?)',
+                                [(key,) + tuple(values) for key, values in scores.items()])
+
+    def close(self):
+        """
+        :return: None
+        """
+        self.db.close()
@@ -0,0 +1,180 @@
+"""
+Output formats shared by our exporters (Topic.export_topics, common.export_texts, VecRelationships.export_json):
+    'json': plain JSON, as the UI has always read it
+    'json.gz', 'json.zst': the same JSON, gzip- or zstd-compressed (zstd needs the zstandard package)
+    'msgpack': MessagePack, a compact binary encoding of the same values (needs the msgpack package)
+Every format can be written as a stream (see ArrayWriter in common), so a big export never has to be built in memory
+first. A compressed or binary file gets the format's suffix after its usual name, e.g., Matthew-Topics.txt.gz.
+"""
+
+import gzip
+import io
+import json
+import os
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class JsonSerializer(object):
+    """
+    Plain JSON (with json.dump's separators and ASCII escaping, so it's byte for byte what we've always written).
+    """
+    name = 'json'
+    suffix = ''
+    compressed = False  # can a reader seek to an item's byte offset? (see ShardWriter in common)
+
+    def wrap(self, file):
+        """
+        :param file: (binary file) An open file to write to.
+        :return: (binary file) Where to write encoded bytes (a compressor in front of file, for compressed formats).
+        """
+        return file
+
+    def finish(self, stream):
+        """
+        Flush anything a compressor is still holding, without closing the underlying file.
+        :param stream: The stream returned by wrap().
+        :return: None
+        """
+        stream.flush()
+
+    def dumps(self, value):
+        """
+        :param value: A JSON-ready value.
+        :return: (bytes) Its encoding.
+        """
+        return json.dumps(value).encode('ascii')
+
+    # A streamed array: start, then items with separators between them, then end.
+    array_start, array_separator, array_end = b'[', b', ', b']'
+
+    def loads(self, data, array=False):
+        """
+        :param data: (bytes) A whole file's bytes, as written (after any decompression; see decompress).
+        :param array: (bool) Was it written as a streamed array?
+        :return: The value.
+        """
+        return json.loads(data.decode('ascii'))
+
+    def decompress(self, data):
+        """
+        :param data: (bytes) A file's bytes.
+        :return: (bytes) The encoded value.
+        """
+        return data
+
+    def load(self, file_name, array=False):
+        """
+        :param file_name: (str) A file written in this format.
+        :param array: (bool) Was it written as a streamed array?
+        :return: The value.
+        """
+        with open(file_name, 'rb') as file:
+            return self.loads(self.decompress(file.read()), array)
+
+
+class GzipJsonSerializer(JsonSerializer):
+    name = 'json.gz'
+    suffix = '.gz'
+    compressed = True
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def wrap(self, file):
+        return gzip.GzipFile(fileobj=file, mode='wb', compresslevel=self.level)
+
+    def finish(self, stream):
+        stream.close()  # writes the gzip trailer; the file itself stays open
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+class ZstdJsonSerializer(JsonSerializer):
+    name = 'json.zst'
+    suffix = '.zst'
+    compressed = True
+
+    def __init__(self, level=10):
+        assert zstandard is not None, 'The json.zst format needs the zstandard package (pip install zstandard).'
+        self.level = level
+
+    def wrap(self, file):
+        return zstandard.ZstdCompressor(level=self.level).stream_writer(file)
+
+    def finish(self, stream):
+        stream.flush(zstandard.FLUSH_FRAME)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+class MessagePackSerializer(JsonSerializer):
+    """
+    MessagePack. A streamed array is written as a sequence of packed items (no header, since we don't know the count
+    up front), which msgpack.Unpacker reads back one at a time; each item stands on its own, so shard offsets (see
+    ShardWriter in common) still point at single items.
+    """
+    name = 'msgpack'
+    suffix = '.msgpack'
+    array_start, array_separator, array_end = b'', b'', b''
+
+    def __init__(self):
+        assert msgpack is not None, 'The msgpack format needs the msgpack package (pip install msgpack).'
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data, array=False):
+        if array:
+            return list(msgpack.Unpacker(io.BytesIO(data), raw=False))
+        return msgpack.unpackb(data, raw=False)
+
+
+SERIALIZERS = {serializer.name: serializer for serializer in
+               (JsonSerializer, GzipJsonSerializer, ZstdJsonSerializer, MessagePackSerializer)}
+
+
+def get_serializer(name):
+    """
+    :param name: (str) A format name: 'json', 'json.gz', 'json.zst' or 'msgpack'.
+    :return: (JsonSerializer) A serializer for that format.
+    """
+    assert name in SERIALIZERS, 'Output formats are: {}.'.format(', '.join(SERIALIZERS))
+    return SERIALIZERS[name]()
+
+
+def for_file(file_name):
+    """
+    :param file_name: (str) A file that one of our formats wrote.
+    :return: (JsonSerializer) A serializer for its format, going by its suffix.
+    """
+    for name, serializer in SERIALIZERS.items():
+        if serializer.suffix and file_name.endswith(serializer.suffix):
+            return serializer()
+    return JsonSerializer()
+
+
+def save(value, file_name, serializer):
+    """
+    Write a whole value in one go: to a temp file next to file_name, then swapped in.
+    :param value: A JSON-ready value.
+    :param file_name: (str) Where to save it (without the format's suffix; we add it).
+    :param serializer: (JsonSerializer) The format.
+    :return: (str, int) The file name we wrote (with its suffix) and its size in bytes.
+    """
+    file_name += serializer.suffix
+    with open(file_name + '.tmp', 'wb') as file:
+        stream = serializer.wrap(file)
+        stream.write(serializer.dumps(value))
+        serializer.finish(stream)
+    os.replace(file_name + '.tmp', file_name)
+    return file_name, os.path.getsize(file_name)
@@ -0,0 +1,142 @@
+"""
+A compact, columnar store for the token features that topic detection reads. Holding on to every spaCy doc for the
+length of a run keeps the whole parse alive; by the time we count topics and ngrams we only need a handful of
+features per token. So we copy those out as each doc comes off the pipeline and let the doc go.
+"""
+
+from array import array
+
+import numpy as np
+from spacy.attrs import DEP, ENT_TYPE, IS_PUNCT, LEMMA, LOWER, POS
+import spacy.symbols as ss
+
+
+class TokenTable(object):
+    """
+    One row per token, for a whole corpus, in contiguous NumPy arrays:
+        lemma, lower: (int32) interned ids into self.strings for token.lemma_ and token.text.lower()
+        pos, ent_type: spaCy's own (already interned) ids for token.pos and token.ent_type
+        punct: (bool) is this token punctuation? (token.dep == ss.punct, or token.is_punct if we skipped the parser)
+    Text i owns rows offsets[i] to offsets[i + 1].
+
+    We also keep the parse's sentence boundaries: sentence j starts at token row sent_rows[j] and spans characters
+    sent_chars[j] = [start, end) of its text, and text i owns sentences sent_offsets[i] to sent_offsets[i + 1].
+    """
+
+    def __init__(self, punct_from_parse=True):
+        """
+        :param punct_from_parse: (bool) Flag punctuation by its dependency label (ss.punct). Set this to False when
+            the language model runs without its parser; we'll use the lexical is_punct flag instead.
+        """
+        self.punct_from_parse = punct_from_parse
+        self.strings = []  # interned strings: {id: string}, as a list
+        self.string_ids = {}  # {string: id}
+        self._hash_ids = {}  # {spaCy string hash: id}, so we only look up each spaCy string once
+
+        # Columns grow as docs arrive (array.array appends cheaply), then finalize() hands them to NumPy.
+        self._columns = {'lemma': array('i'), 'lower': array('i'), 'pos': array('Q'), 'ent_type': array('Q'),
+                         'punct': array('B')}
+        self._offsets = array('q', [0])
+        self._sent_rows, self._sent_chars, self._sent_offsets = array('q'), array('q'), array('q', [0])
+        self.lemma = self.lower = self.pos = self.ent_type = self.punct = self.offsets = None
+        self.sent_rows = self.sent_chars = self.sent_offsets = None
+
+    def __len__(self):
+        """
+        :return: (int) How many texts are in the table.
+        """
+        return len(self._offsets) - 1
+
+    @property
+    def token_count(self):
+        """
+        :return: (int) How many tokens are in the table, across all texts.
+        """
+        return self._offsets[-1]
+
+    def intern(self, string):
+        """
+        :param string: (str) A lemma, a lower-case word, etc.
+        :return: (int) The string's id in this table (adding it if it's new).
+        """
+        if string not in self.string_ids:
+            self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.string_ids[string]
+
+    def add(self, doc):
+        """
+        Copy a doc's token features into the table as the next text. The doc isn't referenced afterward.
+        :param doc: (spaCy doc) A processed doc (see Topic._tokenize).
+        :return: None
+        """
+        punct_attr = DEP if self.punct_from_parse else IS_PUNCT
+        rows = doc.to_array([LEMMA, LOWER, POS, ENT_TYPE, punct_attr]).tolist() if len(doc) else []
+
+        columns = self._columns
+        for token_i, (lemma, lower, pos, ent_type, punct) in enumerate(rows):
+            # A lemma of 0 means spaCy fills it in on request (e.g., for merged tokens), so ask the token.
+            columns['lemma'].append(self._string_id(lemma, doc) if lemma else self.intern(doc[token_i].lemma_))
+            columns['lower'].append(self._string_id(lower, doc))
+            columns['pos'].append(pos)
+            columns['ent_type'].append(ent_type)
+            columns['punct'].append(punct == ss.punct if self.punct_from_parse else punct == 1)
+
+        # Without a parser (or sentencizer), a doc has no sentence boundaries; then the whole text is one sentence.
+        for sent in (doc.sents if doc.is_sentenced else [doc[:]]) if len(doc) else []:
+            self._sent_rows.append(self._offsets[-1] + sent.start)
+            self._sent_chars.extend([sent.start_char, sent.end_char])
+        self._sent_offsets.append(len(self._sent_rows))
+
+        self._offsets.append(self._offsets[-1] + len(rows))
+
+    def _string_id(self, string_hash, doc):
+        """
+        :param string_hash: (int) A spaCy string-store hash (e.g., from doc.to_array).
+        :param doc: (spaCy doc) The doc whose vocab knows the string.
+        :return: (int) Our id for that string.
+        """
+        if string_hash not in self._hash_ids:
+            self._hash_ids[string_hash] = self.intern(doc.vocab.strings[string_hash])
+        return self._hash_ids[string_hash]
+
+    def finalize(self):
+        """
+        Freeze the columns into NumPy arrays (self.lemma, self.lower, ...). Call this after the last add().
+        :return: self
+        """
+        self.lemma = np.frombuffer(self._columns['lemma'], dtype=np.int32)
+        self.lower = np.frombuffer(self._columns['lower'], dtype=np.int32)
+        self.pos = np.frombuffer(self._columns['pos'], dtype=np.uint64)
+        self.ent_type = np.frombuffer(self._columns['ent_type'], dtype=np.uint64)
+        self.punct = np.frombuffer(self._columns['punct'], dtype=np.bool_)
+        self.offsets = np.frombuffer(self._offsets, dtype=np.int64)
+        self.sent_rows = np.frombuffer(self._sent_rows, dtype=np.int64)
+        self.sent_chars = np.frombuffer(self._sent_chars, dtype=np.int64).reshape(-1, 2)
+        self.sent_offsets = np.frombuffer(self._sent_offsets, dtype=np.int64)
+        return self
+
+    @property
+    def norm(self):
+        """
+        The form we use for a token in ngram names and textClean: its lemma, or for pronouns (lemma '-PRON-') its
+        lower-case text.
+        :return: (np.array of int32) String ids, one per token.
+        """
+        return np.where(self.lemma == self.string_ids.get('-PRON-', -1), self.lower, self.lemma)
+
+    def isin(self, column, strings):
+        """
+        :param column: (str) 'lemma' or 'lower'.
+        :param strings: (iterable of str) The strings we're looking for.
+        :return: (np.array of bool) One per token: is that token's string in strings?
+        """
+        ids = [self.string_ids[string] for string in strings if string in self.string_ids]
+        return np.isin(getattr(self, column), np.array(ids, dtype=np.int32))
+
+    def bounds(self, index):
+        """
+        :param index: (int) A text's position in the table.
+        :return: (int, int) The first row and one past the last row of that text.
+        """
+        return int(self.offsets[index]), int(self.offsets[index + 1])
@@ -7,23 +7,41 @@ Helpful links:
 * POS Tags: http://universaldependencies.org/en/pos/all.html#al-en-pos/DET
 """
 
-import json
+import itertools
+import os
 import re
 import string
+import time
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 import spacy
 import spacy.symbols as ss
 
+import common
 import config
+from count_store import CountStore, count_within_budget
+from delta_export import DeltaExport
+import language_model
+import ngram_engine
+import serializers
+from doc_cache import DocCache, file_hash
+from token_table import TokenTable
 
 
 class Topic(object):
     """
     Review a series of texts and extract topics (nouns), maintaining a noun-phrase link to the original texts.
     """
-    nlp = spacy.load('en')
+
+    @property
+    def nlp(self):
+        """
+        The spaCy language model. It's loaded on first use (not at import), once per process, and shared with the
+        other classes that use language_model.load.
+        """
+        return language_model.load()
 
     def __init__(self, corpus_name, corpus, data_date=''):
         """
@@ -49,6 +67,8 @@ class Topic(object):
         self.nouns = {ss.NOUN, ss.PROPN}
         self.entities = {ss.PERSON, ss.NORP, ss.FACILITY, ss.ORG, ss.GPE, ss.LOC, ss.PRODUCT, ss.EVENT, ss.WORK_OF_ART,
                          ss.LANGUAGE}  # spaCy entities that indicate a proper noun.
+        # Punctuation comes from the dependency parse (ss.punct) if we load the parser, otherwise from the lexicon.
+        self.punct_from_parse = 'dep' in config.NLP_FEATURES
 
         # Check the user arguments
         # TODO: What data to I expect in the dictionary passed from the "get_" class?
@@ -66,8 +86,11 @@ class Topic(object):
 
         # Primary Data Structures
         self.texts = corpus  # The dict of dicts that contains all of our texts for analysis: {text_id: {}}
-        self.topics = {}  # A dict of dicts for primary topics: {topic: {}}
-        self.ngrams = {}  # A dict of dicts for ngrams that will help us understand primary topics: {ngram_lemma: {}}
+        self.text_ids = list(corpus['textId'])  # Each text's textId, by position; records hold these positions
+        self.topics = {}  # Records for primary topics: {topic: TopicRecord}
+        self.ngrams = {}  # Records for ngrams that will help us understand primary topics: {ngram_lemma: NgramRecord}
+        self.count_store = None  # Raw counts, if detect_ngram spilled them to disk (a CountStore)
+        self.sentence_sentiment = None  # Compound sentiment for each sentence in self.tokens, from add_sentiment
         self.model_output = {'name': corpus_name,
                              'dataDate': data_date,
                              'runDate': datetime.now().strftime("%Y-%m-%d %H:%M"),
@@ -91,208 +114,273 @@ class Topic(object):
                   'ignore in most text processing.')
             self.stop_words = set()
 
-        # Loop through texts and tokenize: 'textDoc' and 'titleDoc' are lists of spaCy tokens, with named entities called
-        # recognized and joined. 'textClean' is a string of lemmatized words, excluding stopwords and punctuation.
-        # It's used by Doc2Vec.
-        for _, row in self.texts.iterrows():
-            row['textDoc'] = self._tokenize(row['text'])
-            row['titleDoc'] = self._tokenize(row['title'])
-            row['textClean'] = ' '.join([token.text.lower() if token.lemma_ == '-PRON-' else token.lemma_ for
-                                         token in row['textDoc'] if token.lemma_ not in
-                                         self.stop_words and token.text not in self.punct])
-
-    def _tokenize(self, raw_text):
+        self.entity_matcher = language_model.KnownEntityMatcher(self.nlp, self.known_entities, self.entities)
+
+        # Tokenize texts and titles in batches. As each doc comes back (named entities recognized and joined), we copy
+        # the token features we need into compact token tables (self.tokens for texts, self.title_tokens for titles)
+        # and let the doc go, rather than keeping every parse alive for the whole run.
+        start_time = time.time()
+        self.tokens = TokenTable(self.punct_from_parse)
+        self.title_tokens = TokenTable(self.punct_from_parse)
+        for i, doc in enumerate(self._tokenize_all(list(self.texts['text']) + list(self.texts['title']))):
+            (self.tokens if i < len(self.texts) else self.title_tokens).add(doc)
+        self.tokens.finalize()
+        self.title_tokens.finalize()
+
+        token_count = self.tokens.token_count + self.title_tokens.token_count
+        elapsed = max(time.time() - start_time, 1e-6)
+        print('Tokenized {:,} texts and titles ({:,} tokens) in {:.1f}s: {:,.0f} tokens/sec'.format(
+            len(self.texts), token_count, elapsed, token_count / elapsed))
+
+        # 'textClean' is a string of lemmatized words, excluding stopwords and punctuation. It's used by Doc2Vec.
+        # (We write it as a proper column; assigning to an iterrows() row only changes a copy.)
+        keep = ~(self.tokens.isin('lemma', self.stop_words) | self.tokens.isin('lower', self.punct))
+        norm = self.tokens.norm.tolist()
+        text_clean = []
+        for index in range(len(self.tokens)):
+            start, end = self.tokens.bounds(index)
+            text_clean.append(' '.join([self.tokens.strings[norm[i]] for i in range(start, end) if keep[i]]))
+        self.texts = self.texts.assign(textClean=text_clean)
+
+    def _tokenize_all(self, raw_texts):
+        """
+        Called by __init__, _tokenize_all streams our raw texts through the spaCy language model in batches
+        (nlp.pipe) rather than one nlp() call at a time. On big corpora (the whole Bible, a month of posts) the
+        batches are spread across worker processes. Each parsed doc then gets our known-entity and entity-merge
+        post-processing in _tokenize. Texts that we've parsed before (under the same model and input files) come
+        straight from our doc cache instead.
+
+        :param raw_texts: (list of str) The raw texts for analysis.
+        :return: (generator of spaCy docs) The processed docs, in the same order as raw_texts.
+        """
+        raw_texts = [raw_text.strip() for raw_text in raw_texts]
+
+        if config.DOC_CACHE_MAX_BYTES > 0:
+            doc_cache = DocCache(self.nlp.vocab, [self.nlp.meta.get('name', ''), self.nlp.meta.get('version', ''),
+                                                  spacy.__version__, ','.join(self.nlp.pipe_names),
+                                                  language_model.POSTPROCESS_VERSION,
+                                                  file_hash(config.INPUT_DIR + 'known_entities.txt'),
+                                                  file_hash(config.INPUT_DIR + 'stop_words.txt')])
+            keys = [doc_cache.key(raw_text) for raw_text in raw_texts]
+            cached = doc_cache.find(keys)
+        else:
+            doc_cache = None
+            keys = [None] * len(raw_texts)
+            cached = set()
+
+        # Worker processes each need a copy of the model; that's only worth it if we have several batches of work.
+        to_parse = [raw_text for raw_text, key in zip(raw_texts, keys) if key not in cached]
+        n_process = config.TOKENIZE_PROCESSES if len(to_parse) > config.TOKENIZE_BATCH_SIZE else 1
+        parsed = self.nlp.pipe(to_parse, batch_size=config.TOKENIZE_BATCH_SIZE, n_process=n_process)
+
+        for raw_text, key in zip(raw_texts, keys):
+            if key in cached:
+                doc = doc_cache.get(key)
+                if doc is None:  # its pack disappeared after we checked; parse this one on its own
+                    doc = self._tokenize(self.nlp(raw_text))
+            else:
+                doc = self._tokenize(next(parsed))
+                if doc_cache:
+                    doc_cache.add(key, doc)
+            yield doc
+
+        if doc_cache:
+            doc_cache.flush()
+            print('Doc cache: {:,} hits, {:,} misses'.format(doc_cache.hits, doc_cache.misses))
+
+    def _tokenize(self, doc):
         """
-        Called by __init__, _tokenize begins with the plain text from our source, text['text'], applies the spaCy
-        language model to create a token list. Then we loop through each token, looking for 'known entities'. Known
-        Entities are from our own file; we use this check to ensure that the language modeler (specifically the POS,
-        part of speech, tagger) correctly recognizes important named entities (proper nouns that we think are really
-        important, but that are sometimes mis-typed by the model). Second, we look for, then join, multi-word named
-        entities.  These are nearly always referring to the same thing (e.g., first name, last name).
-
-        :param raw_text: (str) The raw text for analysis.
+        Called by _tokenize_all, _tokenize begins with a doc that the spaCy language model has already parsed. We loop
+        through each token, looking for 'known entities'. Known Entities are from our own file; we use this check to
+        ensure that the language modeler (specifically the POS, part of speech, tagger) correctly recognizes important
+        named entities (proper nouns that we think are really important, but that are sometimes mis-typed by the
+        model). Second, we look for, then join, multi-word named entities.  These are nearly always referring to the
+        same thing (e.g., first name, last name).
+
+        :param doc: (spaCy doc) The parsed text.
         :return: (spaCy tokens) The processed text in the form of spaCy tokens.
         """
 
-        doc = self.nlp(raw_text.strip())
-
-        # Loop through tokens and find known entities aren't already marked
-        for token in doc:
-            # Is this word in our known_entities, but is not recognized by the spaCy parser?
-            if token.text.lower() in self.known_entities and token.ent_type not in self.entities:
-                # We need to set the new entity to doc.ents directly (I believe the getter for doc.ents does
-                #     some important massaging.  However, counter to the online docs, setting doc.ents wipes out
-                #     all of the previously recognized ents, so we stash the value, then we combine and reset.
-                stash = doc.ents
-                doc.ents = [(token.text.title(), doc.vocab.strings['PERSON'], token.i, token.i + 1)]
-                doc.ents = doc.ents + stash
-
-        # Find proper noun n-grams: (a) find a known entity, (b) is the next word also a known entity?,
-        #   (c) merge, (d) repeat
+        # Label known entities that the model missed (one pass per doc, multi-word names included).
+        doc = self.entity_matcher(doc)
+
+        # Find proper noun n-grams (runs of entity tokens) and merge each into a single token.
         # TODO: Joining multi-word named entities sometimes causes us trouble.
-        doc_len = len(doc)  # Helps us know when to exit the 'for loop' (since we change the # of items via merge)
-        for token in doc:
-            # if we're not at the end of the loop, and we recognize this as a proper noun and it's not a stop word
-            # and the token isn't a space...
-            if token.i + 1 < doc_len and token.ent_type in self.entities and \
-                            token.text.lower() not in self.stop_words and token.text not in ' ':
-                next_token = doc[token.i + 1]
-                # keep looping while we're not at the end of the loop and this token has the same entity type as
-                # the previous token and it's not a stop word or a space.
-                while token.i + 1 < doc_len and next_token.ent_type == token.ent_type and \
-                                next_token.text.lower() not in self.stop_words and next_token.text not in ' ':
-                    n_gram = doc[token.i:token.i + 2]
-                    n_gram.merge()
-                    doc_len -= 1  # the merge changes the list length, so we just shrunk the list!
-                    # print(x)
-            if token.i + 1 >= doc_len:
-                break
+        return language_model.merge_entities(doc, self.entities, self.stop_words)
 
-        return doc
+    def _token_flags(self):
+        """
+        :return: (np.array, np.array, np.array) Flags for each token in self.tokens: is it a stop word? Is it a stop
+            word or punctuation (never a topic)? Is it a noun or named entity?
+        """
+        tokens = self.tokens
+        stop = tokens.isin('lemma', self.stop_words)
+        skip = tokens.isin('lower', self.punct) | stop
+        nounish = np.isin(tokens.pos, list(self.nouns)) | np.isin(tokens.ent_type, list(self.entities))
+        return stop, skip, nounish
 
-    def increment_topic(self, topic, text_id, verbatim):
+    def add_sentiment(self, processes=None):
         """
-        The value of each topic in self.topics is a dict.
-        If this topic already exists, then simply increment. Otherwise, add the topic dict.
-        :param topic: The lemma of the topic word or phrase
-        :param text_id: The ID where this instance of the topic was found
-        :param verbatim: The original form of this word
+        Score each sentence's sentiment (VADER's compound score, between -1 and 1), using the sentence boundaries from
+        our own parse, so the texts aren't split up again. Each text's sentiment (self.texts['sentiment']) becomes the
+        average of its sentences', and prune_topics_and_adopt gives each topic the average of the sentences it (or
+        one of its children) occurs in.
+        :param processes: (int) See common.score_sentiment.
         :return:
         """
-        if topic in self.topics:
-            self.topics[topic]["count"] += 1
-            self.topics[topic]["textIDs"] |= {text_id}
-            self.topics[topic]["verbatims"] |= {verbatim}
-        else:
-            self.topics[topic] = {"name": topic,
-                                  "count": 1,
-                                  "textIDs": {text_id},
-                                  "verbatims": {verbatim},
-                                  "subtopics": {}}
+        tokens = self.tokens
+        # The character spans are into the (stripped) text that we parsed.
+        raw_texts = [raw_text.strip() for raw_text in self.texts['text']]
+        text_of = np.repeat(np.arange(len(tokens)), np.diff(tokens.sent_offsets)).tolist()
+        sentences = [raw_texts[text][start:end] for text, (start, end) in zip(text_of, tokens.sent_chars.tolist())]
+        self.sentence_sentiment = np.array([score[0] for score in common.score_sentiment(
+            sentences, processes, what='sentences')], dtype=np.float64)
+
+        sentence_counts = np.diff(tokens.sent_offsets)
+        totals = np.bincount(text_of, weights=self.sentence_sentiment, minlength=len(tokens))
+        self.texts = self.texts.assign(sentiment=np.where(sentence_counts > 0, totals / np.maximum(sentence_counts, 1),
+                                                          0.0))
+
+    def _score_topic_sentiment(self):
+        """
+        Give each topic (topic.sentiment) the average sentiment of the sentences that it, or one of its children (in
+        the texts where it's the topic's child), occurs in.
+        :return:
+        """
+        tokens = self.tokens
+        _, skip, nounish = self._token_flags()
+        sentence_of = np.repeat(np.arange(len(tokens.sent_rows)), np.diff(np.append(tokens.sent_rows,
+                                                                                     tokens.token_count)))
+        counted = nounish & ~skip
+
+        # Every spelling of every child (an ngram may be a child of several topics), found in one pass, then sorted
+        # by child so that each child's occurrences are one slice.
+        names = sorted({child.name for topic in self.topics.values() for child in topic.children.values()})
+        rows, owners = [], []
+        for i, name in enumerate(names):
+            for row in ngram_engine.spellings(name, tokens.string_ids):
+                rows.append(row)
+                owners.append(i)
+        text_of = ngram_engine.text_index(tokens)
+        starts, found = ngram_engine.find_ngrams(tokens.norm, text_of, rows)
+        name_of = np.array(owners, dtype=np.int64)[found]
+        order = np.argsort(name_of, kind='stable')
+        starts, bounds = starts[order], np.searchsorted(name_of[order], np.arange(len(names) + 1)).tolist()
+        slices = {name: (bounds[i], bounds[i + 1]) for i, name in enumerate(names)}
+
+        for topic_lemma, topic in self.topics.items():
+            sentences = [sentence_of[(tokens.lemma == tokens.string_ids.get(topic_lemma, -1)) & counted]]
+            for child in topic.children.values():
+                child_starts = starts[slice(*slices[child.name])]
+                child_starts = child_starts[np.isin(text_of[child_starts], child.text_ids.positions())]
+                sentences.append(sentence_of[child_starts])
+
+            sentences = np.unique(np.concatenate(sentences))
+            topic.sentiment = float(self.sentence_sentiment[sentences].mean()) if len(sentences) else None
 
-    def detect_ngram(self, min_topic_count=5, min_text_id_count=4):
+    def detect_ngram(self, min_topic_count=5, min_text_id_count=4, max_ngram_length=5, subtopic_window=7,
+                     processes=None, count_margin=3, text_id_margin=3, approximate=None):
         """
         Find all ngrams within our raw text
         Create ngram counts (absolute and weighted) such that we can find most telling ngrams and know enough to
         (a) prioritize by topic, (b) tie them back to their underlying topic, (c) highlight in the UI
+        The raw counts are kept in self.counts (and saved to config.MODEL_DIR if config.SAVE_COUNTS), so we can try
+        other settings later with reprune() or sweep() without counting again. If they outgrow
+        config.COUNT_MEMORY_BYTES, they're spilled to an on-disk store instead (self.count_store; see count_store).
+        :param min_topic_count, min_text_id_count, count_margin, text_id_margin: See select_topics_and_ngrams.
+        :param max_ngram_length: (int) The longest ngrams we look for (2 or more).
+        :param subtopic_window: (int) A topic within this many tokens of an ngram makes the ngram one of its subtopics.
+        :param processes: (int) Worker processes for counting; 1 counts in this process, -1 uses every core.
+            Defaults to config.COUNT_PROCESSES.
+        :param approximate: (bool) Count ngrams in a fixed memory budget (see ngram_engine.count_approximate and the
+            APPROX_ settings in config), for corpora too large to count exactly. The error bounds go in
+            self.model_output['approximation']. Defaults to config.APPROX_COUNTING.
         :return:
         """
-        for _, row in self.texts.iterrows():
-            # single-word topics act a bit different (no zips or comprehensions)
-            # store data in self.topics, not zip_grams
-            for word in row['textDoc']:
-                # word_lemma = word.text.lower() if word.lemma_ == '-PRON-' else word.lemma_
-
-                if {word.text}.intersection(self.punct) or {word.lemma_}.intersection(self.stop_words):
-                    continue
-
-                if word.pos in self.nouns or word.ent_type in self.entities:
-                    self.increment_topic(word.lemma_, row['textId'], word.text.lower())
-
-        # Populate self.ngrams and self.topics
-        for _, row in self.texts.iterrows():
-            doc = row['textDoc']
-            text_id = row['textId']
-
-            # Find pentagrams - ngrams with 5 words
-            for ngram in zip(doc, doc[1:], doc[2:], doc[3:], doc[4:]):
-                self._ngram_counter(ngram, 5, text_id, doc)
-
-            # Find pentagrams - ngrams with 4 words
-            for ngram in zip(doc, doc[1:], doc[2:], doc[3:]):
-                self._ngram_counter(ngram, 4, text_id, doc)
-
-            for ngram in zip(doc, doc[1:], doc[2:]):
-                self._ngram_counter(ngram, 3, text_id, doc)
-
-            for ngram in zip(doc, doc[1:]):
-                self._ngram_counter(ngram, 2, text_id, doc)
-
-        # Add text_id_count (the number of texts that the topic occurs in; so a topic might occur 50 times,
-        # but it's only mentioned in 3 different texts, we'd show 3.
-        for _, topic in self.topics.items():
-            topic['textIDCount'] = len(topic['textIDs'])
-        for _, ngram in self.ngrams.items():
-            ngram['textIDCount'] = len(ngram['textIDs'])
-
-        # Eliminate rarely occurring topics and ngrams.
-        self.topics = {k: v for k, v in self.topics.items() if
-                       v['textIDCount'] >= min_text_id_count and v['count'] >= min_topic_count}
-        self.ngrams = {k: v for k, v in self.ngrams.items() if
-                       v['textIDCount'] >= min_text_id_count}
-
-        # Loop through each ngram pair: outer loop is all ngrams, inner loop is all ngrams
-        for ngram_lemma, ngram in self.ngrams.items():
-            for ngram_plus_lemma, ngram_plus in self.ngrams.items():
-                # only stay in this loop if the inner ngram is one word longer than the outer loop and if the
-                # inner loop lemma contains the outer group lemma (avoid partial word matches like man in woman)
-                # r'\b' + ngram_lemma + r'\b' --> does the ngram lemma fit in ngram_plus lemma (\b is word boundary)
-                if ngram['n'] + 1 != ngram_plus['n']:
-                    continue
-
-                if not re.search(r'\b' + ngram_lemma + r'\b', ngram_plus_lemma):
-                    continue
-
-                # Is the absolute count of occurrences and the count of text_id occurrences both big enough to use it
-                # instead of the other loop?
-                if ngram_plus['count'] + 3 >= ngram['count'] and ngram_plus['textIDCount'] + 3 >= ngram['textIDCount']:
-                    # TODO: Is this the right action (deleting shorter, but not much more explanatory) phrase?
-                    # TODO: Is this enough?  Or will I end up double explaining things sometimes?
-                    ngram['count'] = -1
-
-        # Eliminate newly demoted items
-        self.ngrams = {ngram_lemma: ngram for ngram_lemma, ngram in self.ngrams.items() if ngram['count'] > 0}
-
-    def _ngram_counter(self, ngram, ngram_length, text_id, doc):
+        assert max_ngram_length >= 2, 'Ngrams have at least 2 words.'
+        tokens = self.tokens
+        processes = config.COUNT_PROCESSES if processes is None else processes
+        approximate = config.APPROX_COUNTING if approximate is None else approximate
+
+        stop, skip, nounish = self._token_flags()
+
+        # Count single-word topics (each noun or named entity) and every ngram (max_ngram_length words, down to 2),
+        # noting the topics near each ngram. With processes > 1, shards of texts are counted in parallel and merged.
+        start_time = time.time()
+        meta = {'name': self.model_output['name'], 'dataDate': self.data_date, 'maxNgramLength': max_ngram_length,
+                'subtopicWindow': subtopic_window}
+        self.count_store = None
+        if approximate:
+            topic_counts, ngram_counts, meta['approximation'] = ngram_engine.count_approximate(
+                tokens, stop, skip, nounish, max_ngram_length, subtopic_window, min_text_id_count, processes,
+                config.COUNT_CHUNK_TEXTS, config.APPROX_SKETCH_WIDTH, config.APPROX_SKETCH_DEPTH,
+                config.APPROX_PROMOTE_TEXT_COUNT, config.APPROX_MAX_CANDIDATES)
+            self.model_output['approximation'] = meta['approximation']
+        elif config.COUNT_MEMORY_BYTES > 0:
+            topic_counts, ngram_counts, self.count_store = count_within_budget(
+                tokens, stop, skip, nounish, max_ngram_length, subtopic_window, config.COUNT_MEMORY_BYTES,
+                config.MODEL_DIR + self._file_name('Counts.sqlite'), processes, config.COUNT_CHUNK_TEXTS)
+        else:
+            topic_counts, ngram_counts = ngram_engine.count_parallel(tokens, stop, skip, nounish, max_ngram_length,
+                                                                     subtopic_window, processes,
+                                                                     config.COUNT_SHARDS_PER_PROCESS)
+        if not approximate:
+            self.model_output.pop('approximation', None)
+
+        if self.count_store is not None:
+            # Counts spilled to disk stay there; select_topics_and_ngrams queries them.
+            self.count_store.set_meta(text_ids=self.text_ids, meta=meta)
+            print('Counted into {} ({:,} spills, {:.1f} MB) in {:.1f}s'.format(
+                self.count_store.file_name, self.count_store.spills, self.count_store.nbytes / 1024 / 1024,
+                time.time() - start_time))
+            self.counts = None
+        else:
+            print('Counted {:,} topics and {:,} distinct ngrams in {:.1f}s'.format(
+                len(topic_counts.lemmas), len(ngram_counts.node_n), time.time() - start_time))
+            self.counts = ngram_engine.CountSnapshot(topic_counts, ngram_counts, tokens.strings, self.text_ids, meta)
+            if config.SAVE_COUNTS:
+                self.counts.save(config.MODEL_DIR + self._file_name('Counts.npz'))
+
+        self.select_topics_and_ngrams(min_topic_count, min_text_id_count, count_margin, text_id_margin)
+
+    def select_topics_and_ngrams(self, min_topic_count=5, min_text_id_count=4, count_margin=3, text_id_margin=3):
         """
-        As we're looping through ngrams, handle the tests to see if we want to keep it (Does it contain a noun? Good.
-         Does it contain punctuation? Bad. Does it begin (or end) with a stopword? Bad). If we keep the phrase, then
-         we need to track a few things about it.
-        :param ngram: (spaCy tokens tuple) The phrase that we're testing
-        :param ngram_length: (int) The length of the ngram
-        :param text_id: The text that this ngram came from...
+        Build self.topics and self.ngrams from our raw counts (self.counts): drop rare topics and ngrams, then drop
+        ngrams that a one-word-longer ngram explains just as well.
+        :param min_topic_count: (int) The fewest times a topic must occur to be kept.
+        :param min_text_id_count: (int) The fewest texts a topic or ngram must occur in to be kept.
+        :param count_margin: (int) A longer ngram replaces an ngram it contains if its count + count_margin
+            reaches the shorter ngram's count...
+        :param text_id_margin: (int) ...and its text id count + text_id_margin reaches the shorter ngram's.
         :return:
         """
-
-        # Only process this ngram is it's punctuation-free (punct --> token.dep == ss.punct) and the 1st / last
-        # words are not stopwords (line mechanics: make a set, look for an intersection with another set)
-        if ([word for word in ngram if word.dep == ss.punct] or
-                {ngram[0].lemma_, ngram[ngram_length - 1].lemma_}.intersection(self.stop_words)):
-            return
-
-        # Only keep this ngram is it has 1+ nouns in it
-        if len([word for word in ngram if word.pos in self.nouns or word.ent_type in self.entities]) == 0:
-            return
-
-        ngram_lemma = ' '.join([word.text.lower() if word.lemma_ == '-PRON-' else word.lemma_ for word in ngram])
-        verbatim = ' '.join([word.text.lower() for word in ngram])
-
-        # add the ngram_lemma to each proximal topic
-        window_start = 0 if ngram[0].i < 7 else ngram[0].i - 7
-        window_end = len(doc) if ngram[0].i + 7 + ngram_length > len(doc) else ngram[0].i + 7 + ngram_length
-        for word in doc[window_start:window_end]:
-            if word.lemma_ in self.topics:  # is this a topic we're tracking?
-                # Yes.  So let's add it to the subtopic dictionary (with an occurrence count)
-                if ngram_lemma in self.topics[word.lemma_]['subtopics']:
-                    self.topics[word.lemma_]['subtopics'][ngram_lemma].add(text_id)
-                else:
-                    self.topics[word.lemma_]['subtopics'][ngram_lemma] = {text_id}
-
-        # Keep it! And it's not the first time we've found it.
-        if ngram_lemma in self.ngrams:
-            self.ngrams[ngram_lemma]["count"] += 1
-            self.ngrams[ngram_lemma]["textIDs"] |= {text_id}
-            self.ngrams[ngram_lemma]["verbatims"] |= {verbatim}
-        # Keep it! This is the 1st instance.
-        else:
-            self.ngrams[ngram_lemma] = {"name": ngram_lemma,
-                                        "count": 1,
-                                        "textIDs": {text_id},
-                                        "n": ngram_length,
-                                        "verbatims": {verbatim},
-                                        "topic_lemmas": []}
+        if self.count_store is not None:
+            self.counts = self.count_store.snapshot(min_topic_count, min_text_id_count)
+        counts = self.counts
+
+        # Eliminate rarely occurring topics and ngrams. (Ngram strings are only built for the ngrams we keep.)
+        # A topic's text_id_count is the number of texts that it occurs in; so a topic might occur 50 times, but
+        # it's only mentioned in 3 different texts, we'd show 3.
+        # Each topic and ngram keeps only its config.MAX_VERBATIMS most common verbatims.
+        self.topics = {k: v for k, v in counts.topic_counts.materialize(counts.strings, config.MAX_VERBATIMS).items()
+                       if v.text_id_count >= min_text_id_count and v.count >= min_topic_count}
+        self.ngrams = counts.ngram_counts.materialize(counts.strings, counts.string_ids, min_text_id_count,
+                                                      self.topics, config.MAX_VERBATIMS)
+
+        # Demote an ngram when a one-word-longer ngram that contains it is (nearly) as common, then drop the demoted.
+        # TODO: Is this the right action (deleting shorter, but not much more explanatory) phrase?
+        # TODO: Is this enough?  Or will I end up double explaining things sometimes?
+        ngram_engine.demote_subsumed(self.ngrams, count_margin, text_id_margin)
+        self.ngrams = {ngram_lemma: ngram for ngram_lemma, ngram in self.ngrams.items() if ngram.count > 0}
 
     def prune_topics_and_adopt(self, max_topics=40, min_subtopic_count=4):
+        """
+        Keep our top topics (by the number of texts they occur in), rank them, and give each its children: the
+        surviving ngrams that occur near it.
+        :param max_topics: (int) About how many topics to keep; topics tied at the cutoff are all kept.
+        :param min_subtopic_count: (int) The fewest texts an ngram must share with a topic to become its child.
+        :return:
+        """
 
         # To find the top X topics (based on max_topics), we'll create a dict that counts the number of topics at
         # each "text ID count" (text ID count = the number of texts that the topic occurs in; so a topic might occur
@@ -300,7 +388,7 @@ class Topic(object):
         rank_tracker = {}  # {text_id_count: count of occurrences}
         for topic_lemma, topic in self.topics.items():
 
-            text_id_count = topic['textIDCount'] = len(topic['textIDs'])
+            text_id_count = topic.text_id_count
             if text_id_count in rank_tracker:
                 rank_tracker[text_id_count] += 1
             else:
@@ -321,49 +409,150 @@ class Topic(object):
                 break
 
         # Only keep topics that fit within our max_topics list
-        self.topics = {k: v for k, v in self.topics.items() if v['textIDCount'] >= min_text_id_count}
+        self.topics = {k: v for k, v in self.topics.items() if v.text_id_count >= min_text_id_count}
 
         # Add children to our top X topics
+        surviving = {ngram.id: (ngram_lemma, ngram) for ngram_lemma, ngram in self.ngrams.items()}
         for topic_lemma, topic in self.topics.items():
-            topic['children'] = {}
-            topic['rank'] = rank_tracker_too[topic['textIDCount']]
+            topic.children = {}
+            topic.rank = rank_tracker_too[topic.text_id_count]
             # topic['children'] = {k: v for k, v in self.ngrams.items() if re.search(r'\b{}\b'.format(topic_lemma), k)}
             # y = sorted(topic['subtopics'].items(), key=lambda x: x[1], reverse=True)[0:7]
 
-            # topic['children'] = {ngam_lemma: ngram for ngam_lemma, ngram in self.ngrams.items() if
-            #                      ngam_lemma in topic['subtopics'] and topic['subtopics'][ngam_lemma] > 3}
-
-
-            for ngram_lemma, ngram in self.ngrams.items():
-                if ngram_lemma in topic['subtopics'] and len(topic['subtopics'][ngram_lemma]) > 3:
-                    topic['children'][ngram_lemma] = ngram.copy()  # We copy so
-                    topic['children'][ngram_lemma]['textIDs'] = topic['subtopics'][ngram_lemma]
-                    topic['children'][ngram_lemma]['textIDCount'] = len(topic['subtopics'][ngram_lemma])
-                    # topic['children'][ngram_lemma]['textIDs'] = \
-                    #     topic['children'][ngram_lemma]['textIDs'].intersection(topic['textIDs'])
-
-                    x = 'hello'
+            # A child only counts the texts where the ngram is near this topic and the topic itself is counted (a
+            # noun or named entity there). With bitmaps, that true co-occurrence is an AND, done for every subtopic at
+            # once. Then we join the subtopics that clear min_subtopic_count (keyed by ngram id) to the surviving
+            # ngrams. Subtopic keys are sorted by id, which is the order of self.ngrams, so children keep that order.
+            together = topic.subtopics.intersect(topic.text_ids)
+            for i in np.nonzero(together.sizes >= min_subtopic_count)[0].tolist():
+                ngram_id = int(together.keys[i])
+                if ngram_id in surviving:
+                    ngram_lemma, ngram = surviving[ngram_id]
+                    topic.children[ngram_lemma] = ngram.with_text_ids(together.bitmap(i))
+
+        if self.sentence_sentiment is not None:
+            self._score_topic_sentiment()
+
+    @classmethod
+    def from_counts(cls, corpus_name, data_date=''):
+        """
+        Rebuild a Topic from the counts that an earlier detect_ngram saved, skipping the texts (and tokenizing)
+        entirely. The result is ready for select_topics_and_ngrams, reprune, sweep and export_topics, but has no
+        self.texts or self.tokens.
+        :param corpus_name: (str) The corpus_name of the run that saved the counts.
+        :param data_date: (str: YYYY-MM-DD) The data_date of that run, if it had one.
+        :return: (Topic)
+        """
+        topic = cls.__new__(cls)
+        topic.corpus_name = corpus_name.replace(' ', '')
+        topic.data_date = data_date
+        # Use whichever the run saved last: counts from memory (.npz), or counts it spilled to disk (.sqlite).
+        file_name, store_name = [config.MODEL_DIR + topic._file_name(suffix) for suffix in ('Counts.npz',
+                                                                                            'Counts.sqlite')]
+        if os.path.exists(store_name) and (not os.path.exists(file_name) or
+                                           os.path.getmtime(store_name) > os.path.getmtime(file_name)):
+            topic.count_store = CountStore(store_name)
+            topic.counts = None
+            text_ids, meta = topic.count_store.get_meta('text_ids'), topic.count_store.get_meta('meta')
+        else:
+            topic.count_store = None
+            topic.counts = ngram_engine.CountSnapshot.load(file_name)
+            text_ids, meta = topic.counts.text_ids, topic.counts.meta
+        topic.text_ids = text_ids
+        topic.topics = {}
+        topic.ngrams = {}
+        topic.sentence_sentiment = None
+        topic.model_output = {'name': meta['name'],
+                              'dataDate': data_date,
+                              'runDate': datetime.now().strftime("%Y-%m-%d %H:%M"),
+                              'textCount': len(topic.text_ids)}
+        if 'approximation' in meta:
+            topic.model_output['approximation'] = meta['approximation']
+        return topic
+
+    def reprune(self, max_topics=40, min_subtopic_count=4, min_topic_count=5, min_text_id_count=4, count_margin=3,
+                text_id_margin=3, file_name=None):
+        """
+        Re-select, re-prune and re-export our topics under new settings, from the raw counts (no counting).
+        :param max_topics, min_subtopic_count: See prune_topics_and_adopt.
+        :param min_topic_count, min_text_id_count, count_margin, text_id_margin: See select_topics_and_ngrams.
+        :param file_name: (str) See export_topics.
+        :return: (dict) The new self.model_output.
+        """
+        start_time = time.time()
+        self.select_topics_and_ngrams(min_topic_count, min_text_id_count, count_margin, text_id_margin)
+        self.prune_topics_and_adopt(max_topics, min_subtopic_count)
+        self.export_topics(file_name)
+        print('Re-pruned to {:,} topics and {:,} ngrams in {:.0f} ms'.format(
+            len(self.topics), len(self.ngrams), (time.time() - start_time) * 1000))
+        return self.model_output
+
+    def sweep(self, **grid):
+        """
+        Re-prune and export once for every combination of settings in grid, e.g.,
+            topic.sweep(max_topics=[20, 40], min_text_id_count=[3, 4, 5])
+        writes Corpus-Topics-max_topics20-min_text_id_count3.txt and 5 more. Settings left out of grid keep their
+        reprune defaults.
+        :param grid: {setting: list of values} for any of reprune's settings (except file_name).
+        :return: (list) One dict per combination: {'settings': {...}, 'fileName': ..., 'topicCount': ...}
+        """
+        settings_allowed = {'max_topics', 'min_subtopic_count', 'min_topic_count', 'min_text_id_count', 'count_margin',
+                            'text_id_margin'}
+        assert set(grid) <= settings_allowed, 'Sweep settings must come from: {}.'.format(
+            ', '.join(sorted(settings_allowed)))
+
+        names = sorted(grid)
+        results = []
+        for values in itertools.product(*[grid[name] for name in names]):
+            settings = dict(zip(names, values))
+            file_name = self._file_name('Topics-{}.txt'.format(
+                '-'.join('{}{}'.format(name, value) for name, value in settings.items())))
+            self.reprune(file_name=file_name, **settings)
+            results.append({'settings': settings, 'fileName': file_name, 'topicCount': len(self.topics)})
+        return results
+
+    def _file_name(self, suffix):
+        """
+        :param suffix: (str) What the file holds, e.g., 'Topics.txt'.
+        :return: (str) XYZ-DD-suffix, where DD is the day of our data_date, or XYZ-suffix if we don't have one.
+        """
+        if self.data_date:
+            date = datetime.strptime(self.data_date, "%Y-%m-%d").strftime('%d')  # from YYYY-MM-DD to DD
+            return '{}-{}-{}'.format(self.corpus_name, date, suffix)
+        return '{}-{}'.format(self.corpus_name, suffix)
 
-    def export_topics(self):
+    def export_topics(self, file_name=None, delta=None, snapshot=False):
         """
         Save topics data to XYZ-Topics.txt. Along the way we'll sort, rank, recalculate some fields (to prep for UI).
          Then prune the dataset (dropping low-usage topics, subtopics).
+        :param file_name: (str) The file name (in config.OUTPUT_DIR) to save to, if not XYZ-Topics.txt. (Compressed and
+            binary formats add their suffix; see config.OUTPUT_FORMAT.)
+        :param delta: (bool) Write only the topics that changed since the last export, plus XYZ-Topics-Manifest.txt (see
+            delta_export), unless this export must be a full snapshot? Defaults to config.DELTA_EXPORTS, but only for
+            XYZ-Topics.txt itself (not reprune's variants).
+        :param snapshot: (bool) With delta, write the full export anyway (and start a new chain of deltas).
         :return:
         """
 
-        # format as a list (for json output), then sort descending by textIDCount
-        topics = [{'name': topic['name'], 'count': topic['count'],
-                   'verbatims': list(topic['verbatims']), 'textIDs': list(topic['textIDs']),
-                   'textIDCount': topic['textIDCount'], 'rank': topic['rank'],
-                   'children': '' if 'children' not in topic else topic['children']}
+        # format as a list (for json output), then sort descending by textIDCount. (Verbatims are most common first.)
+        text_ids = self.text_ids  # records hold text positions; the JSON gets textIds
+        topics = [{'name': topic.name, 'count': topic.count,
+                   'verbatims': list(topic.verbatims),
+                   'textIDs': [text_ids[t] for t in topic.text_ids.positions().tolist()],
+                   'textIDCount': topic.text_id_count, 'rank': topic.rank,
+                   'children': '' if topic.children is None else topic.children}
                   for topic_id, topic in self.topics.items()]
+        for topic, record in zip(topics, self.topics.values()):
+            if record.sentiment is not None:  # only with sentence sentiment (see add_sentiment)
+                topic['sentiment'] = round(record.sentiment, 4)
         topics = sorted(topics, key=lambda topic: topic['textIDCount'], reverse=True)
 
         for i, topic in enumerate(topics):
             # Note that 'rank' is from topic, not child.
-            topic['children'] = [{'name': child['name'], 'count': child['count'], 'rank': topic['rank'],
-                                  'verbatims': list(child['verbatims']), 'textIDs': list(child['textIDs']),
-                                  'textIDCount': child['textIDCount']}
+            topic['children'] = [{'name': child.name, 'count': child.count, 'rank': topic['rank'],
+                                  'verbatims': list(child.verbatims),
+                                  'textIDs': [text_ids[t] for t in child.text_ids.positions().tolist()],
+                                  'textIDCount': child.text_id_count}
                                  for _, child in topic['children'].items()]
 
             topic['children'] = sorted(topic['children'], key=lambda lemma: lemma['textIDCount'], reverse=True)
@@ -380,12 +569,21 @@ class Topic(object):
         # Prune topics over max_topics (default ~40): we stopped calc'ing rank over the max_topics
         self.model_output["children"] = [topic for topic in topics]
 
-        # Build file name and save
-        if self.data_date:
-            date = datetime.strptime(self.data_date, "%Y-%m-%d").strftime('%d')  # from YYYY-MM-DD to DD
-            file_name = '{}-{}-Topics.txt'.format(self.corpus_name, date)
-        else:
-            file_name = '{}-Topics.txt'.format(self.corpus_name)
-
-        with open(config.OUTPUT_DIR + file_name, 'w') as file:
-            json.dump(self.model_output, file)
+        # Build file name and save (or just what changed: see delta_export)
+        delta = DeltaExport('{}-Topics'.format(self.corpus_name), 'name') \
+            if (config.DELTA_EXPORTS and file_name is None if delta is None else delta) else None
+        file_name = file_name or self._file_name('Topics.txt')
+        serializer = serializers.get_serializer(config.OUTPUT_FORMAT)
+        if delta:
+            for topic in self.model_output['children']:
+                delta.add(topic)
+            meta = {key: value for key, value in self.model_output.items() if key != 'children'}
+            if not (snapshot or delta.needs_snapshot()):
+                delta.save(serializer=serializer, meta=meta)
+                return
+
+        # (The serializer encodes it in one go: json.dumps runs the C encoder; json.dump streams through the much
+        # slower pure-Python one.)
+        file_name, _ = serializers.save(self.model_output, config.OUTPUT_DIR + file_name, serializer)
+        if delta:
+            delta.save(os.path.basename(file_name), serializer, meta)
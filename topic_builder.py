@@ -12,17 +12,23 @@ import json
 import re
 import string
 
-import spacy
 import spacy.symbols as ss
 
 import config
+import language_model
 
 
 class TopicBuilder(object):
     """
     Review a series of texts and extract topics (nouns), maintaining a noun-phrase link to the original texts.
     """
-    nlp = spacy.load('en')
+
+    @property
+    def nlp(self):
+        """
+        Our spaCy language model (see language_model.load; the same object Topic uses).
+        """
+        return language_model.load()
 
     def __init__(self, corpus_name, corpus, data_date=''):
         """
@@ -89,6 +95,8 @@ class TopicBuilder(object):
                   'ignore in most text processing.')
             self.stop_words = set()
 
+        self.entity_matcher = language_model.KnownEntityMatcher(self.nlp, self.known_entities, self.entities)
+
         # Loop through texts and tokenize: 'doc' and 'titleDoc' are lists of spaCy tokens, with named entities called
         # recognized and joined. 'textClean' is a string of lemmatized words, excluding stopwords and punctuation.
         # It's used by Doc2Vec.
@@ -114,39 +122,12 @@ class TopicBuilder(object):
 
         doc = self.nlp(raw_text.strip())
 
-        # Loop through tokens and find known entities aren't already marked
-        for token in doc:
-            # Is this word in our known_entities, but is not recognized by the spaCy parser?
-            if token.text.lower() in self.known_entities and token.ent_type not in self.entities:
-                # We need to set the new entity to doc.ents directly (I believe the getter for doc.ents does
-                #     some important massaging.  However, counter to the online docs, setting doc.ents wipes out
-                #     all of the previously recognized ents, so we stash the value, then we combine and reset.
-                stash = doc.ents
-                doc.ents = [(token.text.title(), doc.vocab.strings['PERSON'], token.i, token.i + 1)]
-                doc.ents = doc.ents + stash
-
-        # Find proper noun n-grams: (a) find a known entity, (b) is the next word also a known entity?,
-        #   (c) merge, (d) repeat
-        # TODO: Joining multi-word named entities sometimes causes us trouble.
-        doc_len = len(doc)  # Helps us know when to exit the 'for loop' (since we change the # of items via merge)
-        for token in doc:
-            # if we're not at the end of the loop, and we recognize this as a proper noun and it's not a stop word
-            # and the token isn't a space...
-            if token.i + 1 < doc_len and token.ent_type in self.entities and \
-                            token.text.lower() not in self.stop_words and token.text not in ' ':
-                next_token = doc[token.i + 1]
-                # keep looping while we're not at the end of the loop and this token has the same entity type as
-                # the previous token and it's not a stop word or a space.
-                while token.i + 1 < doc_len and next_token.ent_type == token.ent_type and \
-                                next_token.text.lower() not in self.stop_words and next_token.text not in ' ':
-                    n_gram = doc[token.i:token.i + 2]
-                    n_gram.merge()
-                    doc_len -= 1  # the merge changes the list length, so we just shrunk the list!
-                    # print(x)
-            if token.i + 1 >= doc_len:
-                break
+        # Label known entities that the model missed (one pass per doc, multi-word names included).
+        doc = self.entity_matcher(doc)
 
-        return doc
+        # Find proper noun n-grams (runs of entity tokens) and merge each into a single token.
+        # TODO: Joining multi-word named entities sometimes causes us trouble.
+        return language_model.merge_entities(doc, self.entities, self.stop_words)
 
     def ngram_detection(self, min_topic_count=5, min_text_id_count=4):
         """
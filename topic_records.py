@@ -0,0 +1,263 @@
+"""
+Compact, fixed-shape records for the topics and ngrams that Topic finds. Each used to be a dict holding Python sets of
+textId strings (plus a set of those sets per subtopic), which made a large corpus with a rich vocabulary very memory
+hungry. A record instead holds the positions of its texts (indexes into Topic.text_ids) as a TextBitmap: one bit per
+text, so counting a set is a popcount and intersecting two sets is a bitwise AND. A topic's subtopics are one set of
+posting lists: {ngram id: TextBitmap}.
+"""
+
+import numpy as np
+
+
+# The number of 1 bits in each byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+_BITS = np.arange(64, dtype=np.uint64)
+
+
+class TextBitmap(object):
+    """
+    A set of text positions, one bit per text, in 64-bit words. We only store the words from the set's first text to
+    its last (self.start is the first word's number), so a topic that's only in a few neighboring texts stays small.
+    """
+    __slots__ = ('start', 'words', '_size')
+
+    def __init__(self, start=0, words=None):
+        """
+        :param start: (int) The word number of words[0]; word w holds texts 64 * w to 64 * w + 63.
+        :param words: (np.array of uint64) The bits.
+        """
+        self.start = start
+        self.words = np.zeros(0, dtype=np.uint64) if words is None else words
+        self._size = None
+
+    @classmethod
+    def from_groups(cls, positions, bounds):
+        """
+        Build many bitmaps at once: group i is positions[bounds[i]:bounds[i + 1]]. All of the groups' words go into one
+        shared array (each bitmap is a slice of it), filled with a single vectorized pass.
+        :param positions: (np.array of int) Text positions; sorted, without repeats, within each group.
+        :param bounds: (np.array of int) len(groups) + 1 offsets into positions.
+        :return: (list of TextBitmap) One per group.
+        """
+        return list(PostingLists(np.arange(len(bounds) - 1), *_pack(positions, bounds)).lists())
+
+    def __len__(self):
+        # A vectorized popcount: look up the bit count of every byte at once.
+        if self._size is None:
+            self._size = int(_POPCOUNT[self.words.view(np.uint8)].sum())
+        return self._size
+
+    def __and__(self, other):
+        """
+        :param other: (TextBitmap)
+        :return: (TextBitmap) The texts in both sets.
+        """
+        start = max(self.start, other.start)
+        end = min(self.start + len(self.words), other.start + len(other.words))
+        if end <= start:
+            return TextBitmap()
+        words = self.words[start - self.start:end - self.start] & other.words[start - other.start:end - other.start]
+        nonzero = np.nonzero(words)[0]
+        if not len(nonzero):
+            return TextBitmap()
+        return TextBitmap(start + int(nonzero[0]), words[nonzero[0]:nonzero[-1] + 1].copy())
+
+    def positions(self):
+        """
+        :return: (np.array of int64) The text positions in the set, in order.
+        """
+        word, bit = np.nonzero((self.words[:, None] >> _BITS) & np.uint64(1))
+        return (word + self.start) * 64 + bit
+
+
+class PostingLists(object):
+    """
+    A read-only {key: TextBitmap} mapping for many small sets. Every set's words sit in one flat array, so we can AND
+    all of them with another bitmap (and count the results) in a single vectorized pass; see intersect().
+    """
+    __slots__ = ('keys', 'starts', 'word_bounds', 'words', 'sizes')
+
+    def __init__(self, keys=None, starts=None, word_bounds=None, words=None, sizes=None):
+        """
+        :param keys: (np.array of int) Sorted, distinct keys.
+        :param starts: (np.array of int64) Each set's TextBitmap.start.
+        :param word_bounds: (np.array of int64) len(keys) + 1 offsets: set i is words[word_bounds[i]:word_bounds[i + 1]].
+        :param words: (np.array of uint64) Every set's words, one set after another.
+        :param sizes: (np.array of int64) How many texts are in each set.
+        """
+        self.keys = np.zeros(0, dtype=np.int64) if keys is None else keys
+        self.starts = np.zeros(len(self.keys), dtype=np.int64) if starts is None else starts
+        self.word_bounds = np.zeros(len(self.keys) + 1, dtype=np.int64) if word_bounds is None else word_bounds
+        self.words = np.zeros(0, dtype=np.uint64) if words is None else words
+        self.sizes = np.zeros(len(self.keys), dtype=np.int64) if sizes is None else sizes
+
+    @classmethod
+    def from_pairs(cls, keys, values):
+        """
+        :param keys: (np.array of int) One key per pair.
+        :param values: (np.array of int) One text position per pair. Pairs must be sorted (by key, then value).
+        :return: (PostingLists)
+        """
+        unique, starts = np.unique(keys, return_index=True)
+        return cls(unique.astype(np.int64), *_pack(values, np.append(starts, len(keys))))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def bitmap(self, i):
+        """
+        :param i: (int) A set's position (not its key).
+        :return: (TextBitmap) That set (its words are a view into our flat array).
+        """
+        bitmap = TextBitmap(int(self.starts[i]), self.words[self.word_bounds[i]:self.word_bounds[i + 1]])
+        bitmap._size = int(self.sizes[i])
+        return bitmap
+
+    def get(self, key):
+        """
+        :param key: (int) The key we're looking for.
+        :return: (TextBitmap) The key's set, or None if we don't have the key.
+        """
+        i = int(np.searchsorted(self.keys, key))
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        return self.bitmap(i)
+
+    def lists(self):
+        """
+        :return: (generator) Every set (as a TextBitmap), in key order.
+        """
+        return (self.bitmap(i) for i in range(len(self.keys)))
+
+    def items(self):
+        """
+        :return: (generator) (key, TextBitmap) for every key, in key order.
+        """
+        return zip(self.keys.tolist(), self.lists())
+
+    def intersect(self, bitmap):
+        """
+        AND every one of our sets with bitmap at once.
+        :param bitmap: (TextBitmap)
+        :return: (PostingLists) The same keys; each set holds only the texts that are also in bitmap.
+        """
+        lengths = np.diff(self.word_bounds)
+        # Each of our words' word number, and bitmap's word with the same number (0 where bitmap doesn't reach)
+        number = np.repeat(self.starts - self.word_bounds[:-1], lengths) + np.arange(len(self.words))
+        local = number - bitmap.start
+        inside = (local >= 0) & (local < len(bitmap.words))
+        other = np.zeros(len(self.words), dtype=np.uint64)
+        other[inside] = bitmap.words[local[inside]]
+
+        words = self.words & other
+        word_sizes = _POPCOUNT[words.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+        running = np.concatenate([[0], np.cumsum(word_sizes)])
+        return PostingLists(self.keys, self.starts, self.word_bounds, words,
+                            running[self.word_bounds[1:]] - running[self.word_bounds[:-1]])
+
+
+class TopicRecord(object):
+    """
+    A single-word topic: a noun or named entity, keyed by its lemma.
+    """
+    __slots__ = ('name', 'count', 'text_ids', 'verbatims', 'verbatim_counts', 'subtopics', 'rank', 'children',
+                 'sentiment')
+
+    def __init__(self, name, count, text_ids, verbatims, verbatim_counts, subtopics=None):
+        """
+        :param name: (str) The topic's lemma.
+        :param count: (int) How many times the topic occurs.
+        :param text_ids: (TextBitmap) The positions of the texts that the topic occurs in.
+        :param verbatims: (tuple of str) The most common (lower-case) forms that the topic takes in our texts, most
+            common first.
+        :param verbatim_counts: (tuple of int) How often each of those verbatims occurs.
+        :param subtopics: (PostingLists) {ngram id: the texts where that ngram occurs near this topic}.
+        """
+        self.name = name
+        self.count = count
+        self.text_ids = text_ids
+        self.verbatims = verbatims
+        self.verbatim_counts = verbatim_counts
+        self.subtopics = PostingLists() if subtopics is None else subtopics
+        self.rank = None  # set by Topic.prune_topics_and_adopt, along with children: {ngram_lemma: NgramRecord}
+        self.children = None
+        self.sentiment = None  # the average sentiment of its sentences, if we scored them (see Topic.add_sentiment)
+
+    @property
+    def text_id_count(self):
+        """
+        :return: (int) The number of texts the topic occurs in. (A topic might occur 50 times, but only in 3 texts.)
+        """
+        return len(self.text_ids)
+
+
+class NgramRecord(object):
+    """
+    An ngram of 2 or more words (a phrase), keyed by its words' lemmas.
+    """
+    __slots__ = ('id', 'name', 'count', 'n', 'text_ids', 'verbatims', 'verbatim_counts')
+
+    def __init__(self, id, name, count, n, text_ids, verbatims, verbatim_counts):
+        """
+        :param id: (int) The ngram's id: its position in the order we found ngrams (the keys of topic subtopics).
+        :param name: (str) The ngram's lemmas, joined by spaces.
+        :param count: (int) How many times the ngram occurs.
+        :param n: (int) How many tokens are in the ngram.
+        :param text_ids: (TextBitmap) The positions of the texts that the ngram occurs in.
+        :param verbatims: (tuple of str) The most common (lower-case) forms that the ngram takes in our texts, most
+            common first.
+        :param verbatim_counts: (tuple of int) How often each of those verbatims occurs.
+        """
+        self.id = id
+        self.name = name
+        self.count = count
+        self.n = n
+        self.text_ids = text_ids
+        self.verbatims = verbatims
+        self.verbatim_counts = verbatim_counts
+
+    @property
+    def text_id_count(self):
+        """
+        :return: (int) The number of texts the ngram occurs in.
+        """
+        return len(self.text_ids)
+
+    def with_text_ids(self, text_ids):
+        """
+        :param text_ids: (TextBitmap) Text positions.
+        :return: (NgramRecord) A copy of this ngram that occurs in text_ids (e.g., as a child of one topic).
+        """
+        return NgramRecord(self.id, self.name, self.count, self.n, text_ids, self.verbatims, self.verbatim_counts)
+
+
+def _pack(positions, bounds):
+    """
+    Pack groups of text positions into bitmap words, all groups in one flat array (see PostingLists).
+    :param positions: (np.array of int) Text positions; sorted, without repeats, within each group.
+    :param bounds: (np.array of int) len(groups) + 1 offsets: group i is positions[bounds[i]:bounds[i + 1]].
+    :return: (np.array, np.array, np.array, np.array) starts, word_bounds, words and sizes, as PostingLists takes them.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    bounds = np.asarray(bounds, dtype=np.int64)
+    sizes = np.diff(bounds)
+    word = positions >> 6
+    filled = sizes > 0
+    first = np.zeros(len(sizes), dtype=np.int64)
+    last = np.full(len(sizes), -1, dtype=np.int64)
+    first[filled] = word[bounds[:-1][filled]]
+    last[filled] = word[bounds[1:][filled] - 1]
+
+    word_bounds = np.concatenate([[0], np.cumsum(last - first + 1)]).astype(np.int64)
+    words = np.zeros(int(word_bounds[-1]), dtype=np.uint64)
+    if len(positions):
+        # Each position's word in the flat array; they only increase, so equal words are neighbors to OR together.
+        group = np.repeat(np.arange(len(sizes)), sizes)
+        index = word_bounds[group] + word - first[group]
+        bits = np.left_shift(np.uint64(1), (positions & 63).astype(np.uint64))
+        runs = np.concatenate([[0], np.nonzero(np.diff(index))[0] + 1])
+        words[index[runs]] = np.bitwise_or.reduceat(bits, runs)
+    return first, word_bounds, words, sizes
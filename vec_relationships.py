@@ -13,7 +13,6 @@ doc2vec: https://github.com/linanqiu/word2vec-sentiments/blob/master/run.py
 """
 
 from datetime import datetime
-import json
 import re
 import string
 
@@ -21,6 +20,7 @@ import gensim
 from gensim.models.doc2vec import TaggedDocument
 
 import config
+import serializers
 
 
 class VecRelationships(object):
@@ -236,8 +236,8 @@ class VecRelationships(object):
         else:
             file_name = '{}-Vec.json'.format(self.corpus_name)
 
-        with open(config.OUTPUT_DIR + file_name, 'w') as file:
-            json.dump(self.model_output, file)
+        serializers.save(self.model_output, config.OUTPUT_DIR + file_name,
+                         serializers.get_serializer(config.OUTPUT_FORMAT))
 
 
 if __name__ == "__main__":